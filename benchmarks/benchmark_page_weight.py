@@ -0,0 +1,93 @@
+'''Sizes of what the report page sends over the wire: the initial layout (including its dcc.Store data),
+the request and response of the callback that loads a report section the first time it is shown, and
+of the callback that pages, sorts and filters a listing table on the server. Switching tabs, or between
+tabs and the single page view, runs in the browser and sends no request.
+Uses the Flask test client against the bundled snapshots in src/data and a temporary report cache.
+
+Run from the repository root:
+    python benchmarks/benchmark_page_weight.py
+'''
+import os
+import sys
+import json
+import tempfile
+import warnings
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+warnings.filterwarnings('ignore')
+os.environ['REPORT_CACHE_PATH'] = tempfile.mkdtemp()
+
+import app as report_app
+report_app.DATA_SOURCE = 'local'
+
+# ----------------------------------------------------------------------------
+# BENCHMARK
+# ----------------------------------------------------------------------------
+
+def get_stores(layout):
+    '''Data of the dcc.Store components at the top of the page layout'''
+    return {child['props']['id']: child['props'].get('data') for child in layout['props']['children'] if child['type'] == 'Store'}
+
+def post_section_load(client, section, state):
+    '''Load a report section the way the page does the first time the section is shown and return the
+    request and response sizes in bytes'''
+    shown_id = {'type': 'section_shown', 'section': section}
+    shown_id_text = json.dumps(shown_id, sort_keys=True, separators=(',', ':'))
+    pattern_text = json.dumps({'type': 'section_content', 'section': ['MATCH']}, sort_keys=True, separators=(',', ':'))
+    request_body = json.dumps({'output': pattern_text + '.children',
+                               'outputs': {'id': {'type': 'section_content', 'section': section}, 'property': 'children'},
+                               'inputs': [{'id': shown_id, 'property': 'data', 'value': True}],
+                               'state': [{'id': shown_id, 'property': 'id', 'value': shown_id}] + state,
+                               'changedPropIds': [shown_id_text + '.data']})
+    response = client.post('/_dash-update-component', data=request_body, content_type='application/json')
+    if response.status_code != 200:
+        print('{} returned {}'.format(section, response.status_code))
+    return len(request_body), len(response.data)
+
+def post_listing_page(client, table_name, page_current, sort_by, filter_query, state):
+    '''Ask for one page of a listing table the way its datatable does and return the request and response
+    sizes in bytes'''
+    table_id = {'type': 'listing_table', 'table': table_name}
+    table_id_text = json.dumps(table_id, sort_keys=True, separators=(',', ':'))
+    inputs = {'page_current': page_current, 'page_size': report_app.LISTING_PAGE_SIZE, 'sort_by': sort_by, 'filter_query': filter_query}
+    # The output names the callback by its pattern, the ids of the inputs and outputs are the table's own
+    pattern_text = json.dumps({'type': 'listing_table', 'table': ['MATCH']}, sort_keys=True, separators=(',', ':'))
+    changed_prop = 'filter_query' if filter_query else 'sort_by' if sort_by else 'page_current'
+    request_body = json.dumps({'output': '..{0}.data...{0}.page_count...{0}.page_current..'.format(pattern_text),
+                               'outputs': [{'id': table_id, 'property': prop} for prop in ['data', 'page_count', 'page_current']],
+                               'inputs': [{'id': table_id, 'property': prop, 'value': value} for prop, value in inputs.items()],
+                               'state': [{'id': table_id, 'property': 'id', 'value': table_id}] + state,
+                               'changedPropIds': [table_id_text + '.' + changed_prop]})
+    response = client.post('/_dash-update-component', data=request_body, content_type='application/json')
+    if response.status_code != 200:
+        print('{} page returned {}'.format(table_name, response.status_code))
+    return len(request_body), len(response.data)
+
+if __name__ == '__main__':
+    client = report_app.app.server.test_client()
+
+    response = client.get('/_dash-layout')
+    stores = get_stores(response.get_json())
+    print('{:<32}{:>12}'.format('initial layout', len(response.data)))
+    for store_id, data in stores.items():
+        print('{:<32}{:>12}'.format('  ' + store_id, len(json.dumps(data))))
+
+    state = [{'id': 'store_meta', 'property': 'data', 'value': stores['store_meta']}]
+    print('\n{:<32}{:>12}{:>12}'.format('callback', 'request', 'response'))
+    # Each section is loaded once, when its tab is first opened or the single page view first shows it
+    section_calls = [('load Screening', 'section1'),
+                     ('load Study Status', 'section2'),
+                     ('load Deviations & AE', 'section3'),
+                     ('load Demographics', 'section4')]
+    for name, section in section_calls:
+        request_size, response_size = post_section_load(client, section, state)
+        print('{:<32}{:>12}{:>12}'.format(name, request_size, response_size))
+    print('{:<32}{:>12}{:>12}'.format('switch tab or view', 0, 0))
+
+    listing_calls = [('table 5, page 2', 'table5', 1, [], ''),
+                     ('table 7b, sorted by date', 'table7b', 0, [{'column_id': 'Deviation Date', 'direction': 'desc'}], ''),
+                     ('table 8b, filtered', 'table8b', 0, [], '{Severity} contains "mild"')]
+    for name, table_name, page_current, sort_by, filter_query in listing_calls:
+        request_size, response_size = post_listing_page(client, table_name, page_current, sort_by, filter_query, state)
+        print('{:<32}{:>12}{:>12}'.format(name, request_size, response_size))
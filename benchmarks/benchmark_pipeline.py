@@ -0,0 +1,245 @@
+'''Per-stage benchmark of the report pipeline against the bundled snapshots in src/data. Each stage is timed
+(best of --repeat runs) and run once more under tracemalloc for its peak memory, and the results are compared
+with a saved baseline. Every table produced is checked against its golden copy, recorded from the pipeline
+before the performance work (golden_tables.py), so changes to the pipeline can be measured and shown not to
+change the report.
+
+The report is run for a fixed date so the tables do not depend on the day the benchmark is run.
+
+Run from the repository root:
+    python benchmarks/benchmark_pipeline.py                    # compare with the baseline and golden tables
+    python benchmarks/benchmark_pipeline.py --save-baseline    # record the stage timings as the new baseline
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import warnings
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SRC_PATH = os.path.join(BENCHMARKS_PATH, '..', 'src')
+sys.path.insert(0, SRC_PATH)
+warnings.filterwarnings('ignore')
+
+from data_processing import *
+from app import build_tables_dict, build_content
+from golden_tables import GOLDEN_PATH, REPORT_DATE, TABLES_NAMES, INTENDED_DIFFERENCES, table_to_json, check_tables, load_golden_tables
+
+BASELINE_FILE = os.path.join(GOLDEN_PATH, 'pipeline_baseline.json')
+
+COUNTED_TABLES_NAMES = ["table1a", "table1b", "table3a", "table3b", "table4", "table7a", "table8a"]
+
+# ----------------------------------------------------------------------------
+# PIPELINE STAGES
+# ----------------------------------------------------------------------------
+# Each stage takes the results of the earlier stages (a dictionary) and returns a dictionary of its own
+# results, which are added to it. Stages run in order.
+
+def stage_inputs(results):
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
+    today, start_report, end_report, report_date_msg, report_range_msg = get_time_parameters(REPORT_DATE)
+    return {'display_terms': display_terms, 'display_terms_dict': display_terms_dict, 'display_terms_dict_multi': display_terms_dict_multi,
+            'screening_sites': screening_sites, 'today': REPORT_DATE, 'start_report': start_report, 'end_report': end_report,
+            'page_meta_dict': {'report_date_msg': 'Report generated for ' + str(REPORT_DATE.date()), 'report_range_msg': report_range_msg}}
+
+def stage_get_subjects_json(results):
+    return {'subjects_json': get_subjects_json('subjects', 'subjects-[mcc]-latest.json', source='local')}
+
+def stage_create_clean_subjects(results):
+    subjects, consented, adverse_events = create_clean_subjects(results['subjects_json'], results['screening_sites'], results['display_terms_dict'], results['display_terms_dict_multi'])
+    return {'json_frames': (subjects, consented, adverse_events)}
+
+def stage_load_subjects_files(results):
+    subjects_files = get_subjects_files('subjects', 'subjects-[mcc]-latest.json', source='local')
+    subjects_raw, adverse_effects, record_hashes = load_subjects_files(subjects_files)
+    return {'subjects_raw': subjects_raw, 'adverse_effects': adverse_effects}
+
+def stage_clean_subjects(results):
+    subjects, consented, adverse_events = clean_subjects(results['subjects_raw'], results['adverse_effects'], results['screening_sites'], results['display_terms_dict'], results['display_terms_dict_multi'])
+    return {'clean_frames': {'subjects': subjects, 'consented': consented, 'adverse_events': adverse_events}}
+
+def stage_compact_frames(results):
+    '''The frames as the app keeps them, and as it hands them to the table functions'''
+    compacted = compact_frames(results['clean_frames'])
+    return {'compact_frames': compacted, 'subjects': compacted['subjects'], 'consented': compacted['consented'], 'adverse_events': compacted['adverse_events']}
+
+def stage_get_centers(results):
+    screening_centers_df, centers_df = get_centers(results['subjects'], results['consented'], results['display_terms'])
+    return {'centers_df': centers_df}
+
+def stage_get_table_counts(results):
+    return {'table_counts': get_table_counts(results['subjects'], results['consented'], results['adverse_events'])}
+
+def stage_table_1(results):
+    return {'table1a': get_table_1_screening(results['subjects'], results['consented'], ['screening_site','surgery_type']),
+            'table1b': get_table_1_screening(results['subjects'], results['consented'], ['mcc','surgery_type'])}
+
+def stage_table_2(results):
+    return {'table2a': get_table_2a_screening(results['subjects'], results['display_terms_dict_multi']['reason_not_interested']),
+            'table2b': get_table_2b_screening(results['subjects'], results['start_report'], results['end_report'])}
+
+def stage_table_3(results):
+    return {'table3a': get_table_3_screening(results['consented'], ['screening_site','surgery_type'], results['today'], 30),
+            'table3b': get_table_3_screening(results['consented'], ['mcc','surgery_type'], results['today'], 30)}
+
+def stage_table_4(results):
+    return {'table4': get_table_4(results['consented'], results['today'])}
+
+def stage_tables_5_6(results):
+    table5, table6 = get_tables_5_6(results['consented'])
+    return {'table5': table5, 'table6': table6}
+
+def stage_table_7(results):
+    deviations = get_deviation_records(results['consented'], results['adverse_events'])
+    return {'table7a': get_deviations_by_center(results['centers_df'], results['consented'], deviations, results['display_terms_dict_multi']),
+            'table7b': get_table7b_timelimited(deviations, results['today'])}
+
+def stage_table_8(results):
+    ae = get_adverse_event_records(results['consented'], results['adverse_events'])
+    return {'table8a': get_adverse_events_by_center(results['centers_df'], results['consented'], ae, results['display_terms_dict_multi']),
+            'table8b': get_table_8b(ae, results['today'], None)}
+
+def stage_demographics(results):
+    return get_demographics_tables(results['consented'], results['display_terms_dict'])
+
+def stage_tables_from_counts(results):
+    '''The summary tables as the app builds them, from the table counts'''
+    tables = get_screening_tables(results['subjects'], results['consented'], results['display_terms_dict_multi'], results['today'], results['start_report'], results['end_report'], results['table_counts'])
+    tables.update(get_study_status_tables(results['consented'], results['today'], results['table_counts']))
+    tables.update(get_deviation_and_adverse_event_tables(results['consented'], results['adverse_events'], results['centers_df'], results['display_terms_dict_multi'], results['today'], results['table_counts']))
+    return {'counted_tables': {table_name: tables[table_name] for table_name in COUNTED_TABLES_NAMES}}
+
+def stage_build_tables_dict(results):
+    # datatable_settings_multiindex flattens the table columns in place, so it is given copies
+    return {'tables_dict': build_tables_dict(*[results[table_name].copy() for table_name in TABLES_NAMES])}
+
+def stage_build_content(results):
+    return {'sections': build_content(results['tables_dict'], results['page_meta_dict'])}
+
+stages = [('inputs', stage_inputs),
+          ('get_subjects_json', stage_get_subjects_json),
+          ('create_clean_subjects', stage_create_clean_subjects),
+          ('load_subjects_files', stage_load_subjects_files),
+          ('clean_subjects', stage_clean_subjects),
+          ('compact_frames', stage_compact_frames),
+          ('get_centers', stage_get_centers),
+          ('get_table_counts', stage_get_table_counts),
+          ('table_1', stage_table_1),
+          ('table_2', stage_table_2),
+          ('table_3', stage_table_3),
+          ('table_4', stage_table_4),
+          ('tables_5_6', stage_tables_5_6),
+          ('table_7', stage_table_7),
+          ('table_8', stage_table_8),
+          ('demographics', stage_demographics),
+          ('tables_from_counts', stage_tables_from_counts),
+          ('build_tables_dict', stage_build_tables_dict),
+          ('build_content', stage_build_content)]
+
+# ----------------------------------------------------------------------------
+# MEASUREMENT
+# ----------------------------------------------------------------------------
+
+def run_stage(stage_function, results, repeat):
+    '''Best wall time of repeat runs, and the peak memory allocated by one more run, of a stage'''
+    best = None
+    for i in range(repeat):
+        start_time = time.perf_counter()
+        stage_results = stage_function(results)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    stage_function(results)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return stage_results, best, peak
+
+def run_pipeline(repeat):
+    results, measurements = {}, {}
+    for stage_name, stage_function in stages:
+        stage_results, seconds, peak = run_stage(stage_function, results, repeat)
+        results.update(stage_results)
+        measurements[stage_name] = {'seconds': seconds, 'peak_mb': peak / 2**20}
+    return results, measurements
+
+# ----------------------------------------------------------------------------
+# CHECKS
+# ----------------------------------------------------------------------------
+
+def check_frames_equal(frames, other_frames):
+    '''Names of the cleaned frames that differ between the json and the streaming load'''
+    different = []
+    for frame_name, df, other_df in zip(['subjects', 'consented', 'adverse_events'], frames, other_frames):
+        try:
+            pd.testing.assert_frame_equal(df, other_df)
+        except AssertionError:
+            different.append(frame_name)
+    return different
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage benchmark of the report pipeline')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage; the best time is reported')
+    parser.add_argument('--save-baseline', action='store_true', help='save the stage measurements as the baseline')
+    args = parser.parse_args()
+
+    results, measurements = run_pipeline(args.repeat)
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+
+    print('{:<24}{:>12}{:>12}{:>10}{:>12}{:>12}'.format('stage', 'time (s)', 'base (s)', 'ratio', 'peak (MB)', 'base (MB)'))
+    for stage_name, measurement in measurements.items():
+        base = baseline.get(stage_name, {})
+        ratio = measurement['seconds'] / base['seconds'] if base.get('seconds') else float('nan')
+        print('{:<24}{:>12.4f}{:>12.4f}{:>10.2f}{:>12.1f}{:>12.1f}'.format(stage_name, measurement['seconds'], base.get('seconds', float('nan')),
+                                                                            ratio, measurement['peak_mb'], base.get('peak_mb', float('nan'))))
+    print('{:<24}{:>12.4f}{:>12.4f}'.format('total', sum(m['seconds'] for m in measurements.values()), sum(m.get('seconds', 0) for m in baseline.values())))
+
+    clean_memory, compact_memory = get_frames_memory(results['clean_frames']), get_frames_memory(results['compact_frames'])
+    print('\n{:<24}{:>12}{:>14}{:>10}'.format('frame', 'clean (MB)', 'compact (MB)', 'ratio'))
+    for frame_name in clean_memory:
+        print('{:<24}{:>12.2f}{:>14.2f}{:>10.2f}'.format(frame_name, clean_memory[frame_name] / 2**20, compact_memory[frame_name] / 2**20, compact_memory[frame_name] / clean_memory[frame_name]))
+
+    if args.save_baseline:
+        os.makedirs(GOLDEN_PATH, exist_ok=True)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(measurements, f, indent=1)
+        print('Saved baseline to {}'.format(BASELINE_FILE))
+
+    # Equivalence checks
+    failed = False
+    clean_frames = results['clean_frames']
+    different_frames = check_frames_equal(results['json_frames'], (clean_frames['subjects'], clean_frames['consented'], clean_frames['adverse_events']))
+    if different_frames:
+        failed = True
+        print('Cleaned frames differ between create_clean_subjects and clean_subjects: {}'.format(', '.join(different_frames)))
+
+    counted_tables = results['counted_tables']
+    different_counted = [table_name for table_name in counted_tables if table_to_json(results[table_name]) != table_to_json(counted_tables[table_name])]
+    if different_counted:
+        failed = True
+        print('Tables built from the table counts differ: {}'.format(', '.join(different_counted)))
+
+    golden_tables = load_golden_tables()
+    if golden_tables is not None:
+        different_tables = check_tables(results, golden_tables)
+        if different_tables:
+            failed = True
+            print('Tables differ from their golden copies (or have an empty golden copy): {}'.format(', '.join(different_tables)))
+        else:
+            print('All {} tables match their golden copies'.format(len(TABLES_NAMES)))
+            for table_name, columns in INTENDED_DIFFERENCES.items():
+                print('  except the intended fix to {} {}'.format(table_name, ', '.join(columns)))
+    else:
+        print('No golden tables saved; run benchmarks/golden_tables.py')
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
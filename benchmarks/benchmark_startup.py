@@ -0,0 +1,81 @@
+'''Startup cost of a worker and the per-request cost of the asset files. The time to import the app is
+measured in fresh processes (best and median of --repeat runs), along with the modules that take longest
+to import (python -X importtime). The display terms and screening sites are timed as read and compiled
+from the csv files, and as looked up once compiled for the process.
+
+Run from the repository root:
+    python benchmarks/benchmark_startup.py --repeat 10
+'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+import warnings
+
+import numpy as np
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+warnings.filterwarnings('ignore')
+os.environ.setdefault('DATA_SOURCE', 'local')
+
+IMPORT_APP = 'import time; start_time = time.perf_counter(); import app; print(time.perf_counter() - start_time)'
+
+# ----------------------------------------------------------------------------
+# WORKER STARTUP
+# ----------------------------------------------------------------------------
+
+def time_app_import(repeat):
+    '''Seconds to import the app in each of repeat fresh processes'''
+    seconds = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_APP], cwd=SRC_PATH, capture_output=True, text=True, check=True).stdout
+        seconds.append(float(output.strip().splitlines()[-1]))
+    return seconds
+
+def get_slowest_imports(top_n = 10):
+    '''(cumulative microseconds, module) of the top level imports of the app that take longest'''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=SRC_PATH, capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        # Top level imports of the app are indented by two spaces
+        if module.startswith('   ') and not module.startswith('    '):
+            imports.append((int(cumulative_us), module.strip()))
+    return sorted(imports, reverse=True)[:top_n]
+
+# ----------------------------------------------------------------------------
+# ASSET FILES
+# ----------------------------------------------------------------------------
+
+def time_call(function, repeat = 50):
+    '''Mean milliseconds per call, after a first call'''
+    function()
+    start_time = time.perf_counter()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter() - start_time) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup cost of a worker and per-request cost of the asset files')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh processes to time the app import in')
+    args = parser.parse_args()
+
+    seconds = time_app_import(args.repeat)
+    print('import app: best {:.3f}s, median {:.3f}s over {} processes'.format(min(seconds), np.median(seconds), len(seconds)))
+    print('\n{:<36}{:>12}'.format('slowest top level imports', 'ms'))
+    for cumulative_us, module in get_slowest_imports():
+        print('{:<36}{:>12.1f}'.format(module, cumulative_us / 1000))
+
+    from data_processing import load_display_terms, get_display_terms, get_screening_sites, ASSETS_PATH, pd
+    print('\n{:<36}{:>12}'.format('asset files, per call', 'ms'))
+    print('{:<36}{:>12.3f}'.format('load_display_terms', time_call(lambda: load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv'))))
+    print('{:<36}{:>12.3f}'.format('get_display_terms', time_call(get_display_terms)))
+    print('{:<36}{:>12.3f}'.format('read_csv screening_sites', time_call(lambda: pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv')))))
+    print('{:<36}{:>12.3f}'.format('get_screening_sites', time_call(get_screening_sites)))
+
+if __name__ == '__main__':
+    main()
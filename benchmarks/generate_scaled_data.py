@@ -0,0 +1,101 @@
+'''Write a scaled-up copy of the bundled subjects snapshots, for measuring the dashboard at a multiple of
+today's enrolment. Every record is copied scale times, adverse effects and all, so the distribution of
+record fields and adverse effect instances matches the real data and every count in the report is
+multiplied by the scale.
+
+Record ids must fall in the screening site ranges, which are too narrow for the larger sites at 10x, so
+each range is widened by the scale factor as well: record id r becomes r * scale + copy (copy 0 .. scale-1)
+and the range start..end becomes start * scale .. end * scale + scale - 1, which keeps every copy in the
+range of its original's site. main_record_id is mapped the same way. The expected enrollment of each site
+is multiplied by the scale.
+
+The output directory gets a data/ directory with the subjects files and an assets/ directory with the
+widened screening sites and a copy of the other assets. Run from the repository root:
+    python benchmarks/generate_scaled_data.py --scale 10 --output /tmp/a2cps_10x
+then point the app at it with
+    DATA_SOURCE=local DATA_PATH=/tmp/a2cps_10x/data ASSETS_PATH=/tmp/a2cps_10x/assets
+'''
+import os
+import sys
+import csv
+import json
+import shutil
+import argparse
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+
+from config_settings import DATA_PATH, ASSETS_PATH
+
+MCC_LIST = [1, 2]
+
+# ----------------------------------------------------------------------------
+# SCALING
+# ----------------------------------------------------------------------------
+
+def scale_id(record_id, scale, copy):
+    '''Id of a copy of a record, or the id unchanged if it is not a number (e.g. 'N/A')'''
+    try:
+        return str(int(record_id) * scale + copy)
+    except (TypeError, ValueError):
+        return record_id
+
+def write_scaled_subjects(subjects_file, scaled_file, scale):
+    '''Write scale copies of each record of a subjects json file. Returns the number of records and of
+    adverse effect instances written.'''
+    with open(subjects_file, 'r') as f:
+        subjects = json.load(f)
+
+    records_count, adverse_effects_count = 0, 0
+    with open(scaled_file, 'w') as f:
+        f.write('{')
+        for record_id, record in subjects.items():
+            for copy in range(scale):
+                scaled_record = dict(record)
+                scaled_record['main_record_id'] = scale_id(record.get('main_record_id'), scale, copy)
+                if records_count > 0:
+                    f.write(', ')
+                f.write(json.dumps(scale_id(record_id, scale, copy)) + ': ' + json.dumps(scaled_record))
+                records_count += 1
+                adverse_effects_count += len(record.get('adverse_effects') or {})
+        f.write('}')
+    return records_count, adverse_effects_count
+
+def scale_expected_enrollment(expected_enrollment, scale):
+    if not expected_enrollment.strip():
+        return expected_enrollment
+    return ', '.join(str(int(value) * scale) for value in expected_enrollment.split(','))
+
+def write_scaled_screening_sites(screening_sites_file, scaled_file, scale):
+    '''Copy screening_sites.csv with the record id ranges and expected enrollment multiplied by scale'''
+    with open(screening_sites_file, 'r', newline='', encoding='utf-8-sig') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        row['record_id_start'] = str(int(row['record_id_start']) * scale)
+        row['record_id_end'] = str(int(row['record_id_end']) * scale + scale - 1)
+        row['expected_enrollment'] = scale_expected_enrollment(row['expected_enrollment'], scale)
+    with open(scaled_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a scaled-up copy of the bundled subjects snapshots')
+    parser.add_argument('--scale', type=int, default=10, help='copies of each record')
+    parser.add_argument('--output', required=True, help='output directory')
+    args = parser.parse_args()
+
+    data_path, assets_path = os.path.join(args.output, 'data'), os.path.join(args.output, 'assets')
+    os.makedirs(data_path, exist_ok=True)
+    shutil.copytree(ASSETS_PATH, assets_path, dirs_exist_ok=True)
+    write_scaled_screening_sites(os.path.join(ASSETS_PATH, 'screening_sites.csv'), os.path.join(assets_path, 'screening_sites.csv'), args.scale)
+
+    for mcc in MCC_LIST:
+        subjects_filename = 'subjects-{}-latest.json'.format(mcc)
+        records_count, adverse_effects_count = write_scaled_subjects(os.path.join(DATA_PATH, subjects_filename), os.path.join(data_path, subjects_filename), args.scale)
+        print('MCC{}: {} records, {} adverse effect instances'.format(mcc, records_count, adverse_effects_count))
+
+    print('DATA_SOURCE=local DATA_PATH={} ASSETS_PATH={}'.format(data_path, assets_path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+'''Golden copies of the report tables, recorded from the pipeline as it was before the performance work
+(the baseline commit) and checked by benchmark_pipeline.py. Tables are stored as json (pandas 'split'
+format plus the dtypes) with dates written as text by strftime, so the copies are readable and compare
+equal under any pandas version.
+
+To record them again, check out the baseline and run this script against its src directory, from the
+repository root:
+    git worktree add /tmp/a2cps-baseline <baseline commit>
+    python benchmarks/golden_tables.py --src /tmp/a2cps-baseline/src
+'''
+import os
+import sys
+import json
+import argparse
+import warnings
+from datetime import datetime
+
+import pandas as pd
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_PATH = os.path.join(BENCHMARKS_PATH, 'golden')
+GOLDEN_TABLES_FILE = os.path.join(GOLDEN_PATH, 'pipeline_tables.json')
+
+REPORT_DATE = datetime(2022, 8, 15)
+TABLES_NAMES = ["table1a", "table1b", "table2a", "table2b", "table3a", "table3b", "table4", "table5", "table6",
+                "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age"]
+
+# Columns of the golden tables the pipeline has since been changed to fix. The baseline joined the
+# consented counts by MCC on an int against a str, so the Consented and % Enrolled columns of table1b
+# were empty.
+INTENDED_DIFFERENCES = {'table1b': ['Consented', '% Enrolled']}
+
+# ----------------------------------------------------------------------------
+# GOLDEN TABLES
+# ----------------------------------------------------------------------------
+
+def format_dates(df):
+    '''Copy of a dataframe with its datetime columns and index as ISO text'''
+    df = df.copy()
+    for i in range(df.shape[1]):
+        if pd.api.types.is_datetime64_any_dtype(df.iloc[:, i]):
+            df.iloc[:, i] = df.iloc[:, i].dt.strftime('%Y-%m-%dT%H:%M:%S')
+    if pd.api.types.is_datetime64_any_dtype(df.index):
+        df.index = df.index.strftime('%Y-%m-%dT%H:%M:%S')
+    return df
+
+def table_to_json(df):
+    return {'dtypes': [str(dtype) for dtype in df.dtypes], 'table': json.loads(format_dates(df).to_json(orient='split', default_handler=str))}
+
+def drop_columns(table_json, columns):
+    '''A table's json without the columns whose name (or, for multiindex columns, any level) is in columns'''
+    table = table_json['table']
+    keep = [i for i, col in enumerate(table['columns']) if not set(col if isinstance(col, list) else [col]) & set(columns)]
+    return {'dtypes': [table_json['dtypes'][i] for i in keep],
+            'table': dict(table, columns=[table['columns'][i] for i in keep], data=[[row[i] for i in keep] for row in table['data']])}
+
+def check_tables(tables, golden_tables, intended_differences = INTENDED_DIFFERENCES):
+    '''Names of the tables that differ from their golden copy, apart from the intended differences. A table
+    whose golden copy is missing or has no rows checks nothing, so it is reported as well.'''
+    different = []
+    for table_name in TABLES_NAMES:
+        if table_name not in golden_tables or not golden_tables[table_name]['table']['data']:
+            different.append(table_name)
+            continue
+        table_json, golden_json = table_to_json(tables[table_name]), golden_tables[table_name]
+        if table_name in intended_differences:
+            table_json, golden_json = drop_columns(table_json, intended_differences[table_name]), drop_columns(golden_json, intended_differences[table_name])
+        if table_json != golden_json:
+            different.append(table_name)
+    return different
+
+def load_golden_tables(golden_tables_file = GOLDEN_TABLES_FILE):
+    if not os.path.exists(golden_tables_file):
+        return None
+    with open(golden_tables_file, 'r') as f:
+        return json.load(f)
+
+# ----------------------------------------------------------------------------
+# RECORD
+# ----------------------------------------------------------------------------
+
+def get_report_tables(src_path):
+    '''The report tables for REPORT_DATE from the pipeline in src_path, run the way the baseline's
+    serve_layout ran it. The baseline's table 7b covered the week before the app was loaded, so it is
+    made again here for the week before REPORT_DATE.'''
+    sys.path.insert(0, src_path)
+    os.environ.setdefault('DATA_SOURCE', 'local')
+    from data_processing import (load_display_terms, get_subjects_json, create_clean_subjects, get_centers, get_time_parameters, get_tables,
+                                 get_deviation_records, get_table7b_timelimited, ASSETS_PATH)
+
+    display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
+    screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
+    today, start_report, end_report, report_date_msg, report_range_msg = get_time_parameters(REPORT_DATE)
+    subjects_json = get_subjects_json('subjects', 'subjects-[mcc]-latest.json', source='local')
+    subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+    screening_centers_df, centers_df = get_centers(subjects, consented, display_terms)
+    tables = get_tables(REPORT_DATE, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df)
+    tables = dict(zip(TABLES_NAMES, tables))
+    tables['table7b'] = get_table7b_timelimited(get_deviation_records(consented, adverse_events), REPORT_DATE)
+    return tables
+
+def main():
+    parser = argparse.ArgumentParser(description='Record the golden copies of the report tables')
+    parser.add_argument('--src', required=True, help='src directory of a checkout of the baseline commit')
+    args = parser.parse_args()
+    warnings.filterwarnings('ignore')
+
+    tables = get_report_tables(os.path.abspath(args.src))
+    os.makedirs(GOLDEN_PATH, exist_ok=True)
+    with open(GOLDEN_TABLES_FILE, 'w') as f:
+        json.dump({table_name: table_to_json(tables[table_name]) for table_name in TABLES_NAMES}, f, indent=1)
+    print('Saved golden tables to {}'.format(GOLDEN_TABLES_FILE))
+
+if __name__ == '__main__':
+    main()
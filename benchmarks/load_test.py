@@ -0,0 +1,155 @@
+'''Load test of the report page: bursts of concurrent requests for the page layout (serve_layout), the
+callback that loads a report section the first time it is shown (load_report_section) and the Excel
+download (click_excel), reporting latency percentiles and payload sizes for each. Switching tabs or
+between tabs and the single page view runs in the browser, so there is no request to test for it.
+
+By default requests go to the app in this process through the Flask test client. To test the gunicorn
+setup, start it with the same settings and pass its address with --url, e.g.
+    cd src && DATA_SOURCE=local gunicorn --preload -w 16 -b :8050 app:server
+    python benchmarks/load_test.py --url http://localhost:8050 --requests 200 --concurrency 32
+
+Point DATA_PATH and ASSETS_PATH at the output of generate_scaled_data.py to test scaled-up data. Run from
+the repository root:
+    python benchmarks/load_test.py --requests 50 --concurrency 16
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import warnings
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+warnings.filterwarnings('ignore')
+os.environ.setdefault('DATA_SOURCE', 'local')
+
+SCENARIOS = ['layout', 'section', 'excel']
+
+# ----------------------------------------------------------------------------
+# CLIENTS
+# ----------------------------------------------------------------------------
+# Both clients return (status code, response body bytes) for a GET, or for a POST of a json body.
+
+class TestClient:
+    '''Requests to the app in this process, with a Flask test client per thread'''
+    def __init__(self):
+        os.environ.setdefault('REPORT_CACHE_PATH', tempfile.mkdtemp())
+        import app as report_app
+        self.server = report_app.app.server
+        self.prefix = report_app.REQUESTS_PATHNAME_PREFIX
+        self.local = threading.local()
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.server.test_client()
+        return self.local.client
+
+    def request(self, path, body = None):
+        if body is None:
+            response = self.client().get(self.prefix + path)
+        else:
+            response = self.client().post(self.prefix + path, data=body, content_type='application/json')
+        return response.status_code, response.data
+
+class UrlClient:
+    '''Requests to a running server'''
+    def __init__(self, url):
+        self.url = url.rstrip('/') + '/'
+
+    def request(self, path, body = None):
+        data = body.encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+# ----------------------------------------------------------------------------
+# SCENARIOS
+# ----------------------------------------------------------------------------
+
+def get_callback_body(output, input_id, input_value, store_meta):
+    '''Request body of a callback, as the browser sends it'''
+    output_id, output_property = output.split('.')
+    input_id, input_property = input_id.split('.')
+    return json.dumps({'output': output,
+                       'outputs': {'id': output_id, 'property': output_property},
+                       'inputs': [{'id': input_id, 'property': input_property, 'value': input_value}],
+                       'state': [{'id': 'store_meta', 'property': 'data', 'value': store_meta}],
+                       'changedPropIds': ['.'.join([input_id, input_property])]})
+
+def get_section_body(section, store_meta):
+    '''Request body of load_report_section for a section shown for the first time'''
+    shown_id = {'type': 'section_shown', 'section': section}
+    return json.dumps({'output': '{"section":["MATCH"],"type":"section_content"}.children',
+                       'outputs': {'id': {'type': 'section_content', 'section': section}, 'property': 'children'},
+                       'inputs': [{'id': shown_id, 'property': 'data', 'value': True}],
+                       'state': [{'id': shown_id, 'property': 'id', 'value': shown_id},
+                                 {'id': 'store_meta', 'property': 'data', 'value': store_meta}],
+                       'changedPropIds': [json.dumps(shown_id, sort_keys=True, separators=(',', ':')) + '.data']})
+
+def get_store_meta(layout):
+    for child in layout['props']['children']:
+        if child['type'] == 'Store' and child['props']['id'] == 'store_meta':
+            return child['props']['data']
+
+def get_scenario_requests(store_meta):
+    '''(path, body) of the request for each scenario'''
+    return {'layout': ('_dash-layout', None),
+            'section': ('_dash-update-component', get_section_body('section3', store_meta)),
+            'excel': ('_dash-update-component', get_callback_body('download-dataframe-xlxs.data', 'btn_xlxs.n_clicks', 1, store_meta))}
+
+def timed_request(client, path, body):
+    start_time = time.perf_counter()
+    status, content = client.request(path, body)
+    return time.perf_counter() - start_time, status, len(content)
+
+def run_burst(client, path, body, requests_count, concurrency):
+    '''Send requests_count requests, concurrency at a time. Returns the latencies, statuses and sizes and
+    the wall time of the burst.'''
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: timed_request(client, path, body), range(requests_count)))
+    return results, time.perf_counter() - start_time
+
+def print_results(name, results, wall_time):
+    latencies = np.array([latency for latency, status, size in results]) * 1000
+    errors = sum(1 for latency, status, size in results if status != 200)
+    sizes = [size for latency, status, size in results]
+    print('{:<10}{:>8}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>12}'.format(name, len(results), errors,
+          np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99), latencies.max(), latencies.mean(),
+          len(results) / wall_time, int(np.median(sizes))))
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the report page')
+    parser.add_argument('--url', help='address of a running server; by default the app is run in this process')
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight at once')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated list of ' + ', '.join(SCENARIOS))
+    args = parser.parse_args()
+
+    client = UrlClient(args.url) if args.url else TestClient()
+
+    # The first request builds the report (unless the server has it cached), so it is timed on its own
+    latency, status, size = timed_request(client, '_dash-layout', None)
+    print('first layout request: {:.1f} ms, status {}, {} bytes'.format(latency * 1000, status, size))
+    status, content = client.request('_dash-layout')
+    store_meta = get_store_meta(json.loads(content))
+    scenario_requests = get_scenario_requests(store_meta)
+
+    print('{:<10}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('scenario', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'mean ms', 'req/s', 'bytes'))
+    for name in args.scenarios.split(','):
+        path, body = scenario_requests[name]
+        results, wall_time = run_burst(client, path, body, args.requests, args.concurrency)
+        print_results(name, results, wall_time)
+
+if __name__ == '__main__':
+    main()
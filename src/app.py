@@ -2,28 +2,33 @@
 # PYTHON LIBRARIES
 # ----------------------------------------------------------------------------
 import traceback
+import time
+import gc
+import threading
 
 # Dash Framework
 import dash_bootstrap_components as dbc
-from dash import Dash, callback, clientside_callback, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL
+from dash import Dash, callback, callback_context, clientside_callback, no_update, html, dcc, dash_table as dt, Input, Output, State, MATCH, ALL
 from dash.exceptions import PreventUpdate
 import dash_daq as daq
 
 from dash_extensions import Download
-from dash_extensions.snippets import send_file
 
 # import local modules
 from config_settings import *
 from data_processing import *
 from styling import *
+from report_cache import *
+from delta_processing import *
+from metrics import *
+from request_profiler import *
+from listing_tables import *
 
 # for export
 import io
+import base64
 import flask
 
-# Plotly graphing
-import plotly.graph_objects as go
-
 # ----------------------------------------------------------------------------
 # DEBUGGING
 # ----------------------------------------------------------------------------
@@ -59,10 +64,20 @@ mcc_list=[1,2]
 # ----------------------------------------------------------------------------
 # FUNCTIONS FOR DASH UI COMPONENTS
 # ----------------------------------------------------------------------------
-def build_datatable_from_table_dict(table_dict, key, table_id, fill_width = False):
+def build_datatable_from_table_dict(table_dict, key, table_id, fill_width = False, listing = False):
+    '''Datatable of a table from the tables dictionary. A listing table is sent one page at a time: its
+    paging, sorting and filtering are done on the server by the update_listing_page callback.'''
     try:
         table_columns = table_dict[key]['columns_list']
         table_data = table_dict[key]['data']
+        listing_settings = {}
+        if listing:
+            table_id = {'type': 'listing_table', 'table': key}
+            listing_settings = {'page_action': 'custom', 'page_current': 0, 'page_size': LISTING_PAGE_SIZE,
+                                'page_count': max(1, math.ceil(len(table_data) / LISTING_PAGE_SIZE)),
+                                'sort_action': 'custom', 'sort_mode': 'multi', 'sort_by': [],
+                                'filter_action': 'custom', 'filter_query': ''}
+            table_data = table_data[:LISTING_PAGE_SIZE]
         new_datatable =  dt.DataTable(
                 id = table_id,
                 columns=table_columns,
@@ -91,6 +106,7 @@ def build_datatable_from_table_dict(table_dict, key, table_id, fill_width = Fals
                 # style_table={'overflowX': 'auto'},
                 # export_format="csv",
                 merge_duplicate_headers=True,
+                **listing_settings
             )
         return new_datatable
     except Exception as e:
@@ -98,6 +114,8 @@ def build_datatable_from_table_dict(table_dict, key, table_id, fill_width = Fals
         return None
 
 def generate_enrollment_figure(df, x_col, bar_col, line_col, title):
+    # Plotly graphing, imported on first use: the report pages do not show figures at the moment
+    import plotly.graph_objects as go
     fig = go.Figure()
 
     fig.add_trace(
@@ -198,43 +216,31 @@ def generate_site_div(site, df, id_index, table_display = 'none'):
 # ----------------------------------------------------------------------------
 
 
-def build_tables_dict(table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age):
-    tables_names = ("table1a", "table1b", "table2a", "table2b", "table3a", "table3b","table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age")
-    excel_sheet_names = ("Screened_site","Screened_MCC", "Decline_Reasons", "Decline_Comments", "Consent_site","Consent_mcc", "Study_Status", "Rescinded_Consent", "Early_Termination", "Protocol_Deviations", "Protocol_Deviations_Description",
-    "Adverse_Events", "Adverse_Events_Description", "Gender", "Race", "Ethnicity", "Age")
-
-    tables = (table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age)
+excel_sheet_names = {"table1a": "Screened_site", "table1b": "Screened_MCC", "table2a": "Decline_Reasons", "table2b": "Decline_Comments",
+                     "table3a": "Consent_site", "table3b": "Consent_mcc", "table4": "Study_Status", "table5": "Rescinded_Consent",
+                     "table6": "Early_Termination", "table7a": "Protocol_Deviations", "table7b": "Protocol_Deviations_Description",
+                     "table8a": "Adverse_Events", "table8b": "Adverse_Events_Description", "sex": "Gender", "race": "Race",
+                     "ethnicity": "Ethnicity", "age": "Age"}
 
+@timed_stage
+def get_tables_dict(tables):
+    '''Convert a dictionary of table name: dataframe into the datatable settings used by the page and the excel export'''
     tables_dict = {}
-
-    for i in range(0,len(tables_names)):
-        table_name = tables_names[i]
-        excel_sheet_name = excel_sheet_names[i]
-        data_source = tables[i]
+    for table_name, data_source in tables.items():
         columns_list, datatable_data = datatable_settings_multiindex(data_source)
-
-        # if(data_source.columns.nlevels == 2):
-        #     columns_list = []
-        #     for i in data_source.columns:
-        #         col_id = i[0] + ':' + i[1]
-        #         columns_list.append({"name": [i[0],i[1]], "id": col_id})
-        #     data_source.columns = data_source.columns.droplevel()
-        # else:
-        #     columns_list = [{"name": i, "id": i} for i in data_source.columns]
-
-
-
-        tables_dict[table_name] = {'excel_sheet_name': excel_sheet_name,
+        tables_dict[table_name] = {'excel_sheet_name': excel_sheet_names[table_name],
                                     'columns_list': columns_list,
                                     'data': datatable_data
-                                    # 'data': data_source.to_dict('records')
                                     }
-
-
     return tables_dict
 
-def build_content(tables_dict, page_meta_dict):
+def build_tables_dict(table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age):
+    tables_names = ("table1a", "table1b", "table2a", "table2b", "table3a", "table3b","table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age")
+    tables = (table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age)
+    return get_tables_dict(dict(zip(tables_names, tables)))
 
+@timed_stage
+def build_section1(tables_dict, page_meta_dict):
     report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section1 = html.Div([
@@ -272,7 +278,7 @@ def build_content(tables_dict, page_meta_dict):
             dbc.CardBody([
                 html.H6('Table 2.b. Reasons for declining ‘Additional Comments’'),
                 html.Div([report_range_msg]),
-                html.Div(build_datatable_from_table_dict(tables_dict, 'table2b', 'table_2b')),
+                html.Div(build_datatable_from_table_dict(tables_dict, 'table2b', 'table_2b', listing=True)),
             ]),
         ),
         dbc.Card(
@@ -298,6 +304,11 @@ def build_content(tables_dict, page_meta_dict):
             ]),
         ),
     ])
+    return section1
+
+@timed_stage
+def build_section2(tables_dict, page_meta_dict):
+    report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section2 = html.Div([
         dbc.Card([
@@ -313,14 +324,19 @@ def build_content(tables_dict, page_meta_dict):
             #     label=['Previous Week','Cumulative'],
             #     value=False
             # ),
-            html.Div(build_datatable_from_table_dict(tables_dict, 'table5', 'table_5')),
+            html.Div(build_datatable_from_table_dict(tables_dict, 'table5', 'table_5', listing=True)),
         ],body=True),
         dbc.Card([
             html.H5('Table 6. Early Study Termination Listing'),
             html.Div([report_date_msg]),
-            html.Div(build_datatable_from_table_dict(tables_dict, 'table6', 'table_6')),
+            html.Div(build_datatable_from_table_dict(tables_dict, 'table6', 'table_6', listing=True)),
         ],body=True),
     ])
+    return section2
+
+@timed_stage
+def build_section3(tables_dict, page_meta_dict):
+    report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section3 = html.Div([
         dbc.Card([
@@ -343,7 +359,7 @@ def build_content(tables_dict, page_meta_dict):
             dbc.CardBody([
                 html.H5('Table 7.b. Description of Protocol Deviations'),
                 html.Div([report_range_msg]),
-                html.Div(build_datatable_from_table_dict(tables_dict, 'table7b', 'table_7b')),
+                html.Div(build_datatable_from_table_dict(tables_dict, 'table7b', 'table_7b', listing=True)),
             ]),
         ]),
         dbc.Card([
@@ -354,9 +370,14 @@ def build_content(tables_dict, page_meta_dict):
         dbc.Card([
             html.H5('Table 8.b. Description of Adverse Events'),
             html.Div([report_range_msg]),
-            html.Div(build_datatable_from_table_dict(tables_dict, 'table8b', 'table_8b')),
+            html.Div(build_datatable_from_table_dict(tables_dict, 'table8b', 'table_8b', listing=True)),
         ],body=True),
     ])
+    return section3
+
+@timed_stage
+def build_section4(tables_dict, page_meta_dict):
+    report_date_msg, report_range_msg = page_meta_dict['report_date_msg'], page_meta_dict['report_range_msg']
 
     section4 = html.Div([
         dbc.Card([
@@ -372,17 +393,15 @@ def build_content(tables_dict, page_meta_dict):
             html.Div(build_datatable_from_table_dict(tables_dict, 'age', 'table_9d')),
         ],body=True),
     ])
+    return section4
 
+def build_content(tables_dict, page_meta_dict):
+    section1 = build_section1(tables_dict, page_meta_dict)
+    section2 = build_section2(tables_dict, page_meta_dict)
+    section3 = build_section3(tables_dict, page_meta_dict)
+    section4 = build_section4(tables_dict, page_meta_dict)
     return section1, section2, section3, section4
 
-def get_sections_dict_for_store(section1, section2, section3, section4):
-    sections_dict = {}
-    sections_dict['section1'] = section1
-    sections_dict['section2'] = section2
-    sections_dict['section3'] = section3
-    sections_dict['section4'] = section4
-    return sections_dict
-
 # ----------------------------------------------------------------------------
 # DASH APP LAYOUT FUNCTION
 # ----------------------------------------------------------------------------
@@ -404,100 +423,230 @@ def subjects_report(page_meta_dict):
                         ),
                     ],id='print-hide', className='print-hide'),
                     html.H5(page_meta_dict['report_date_msg']),
+                    html.P(page_meta_dict['report_age_msg']) if 'report_age_msg' in page_meta_dict else None,
                     html.Div(id='download-msg'),
                 ],width=12),
             ]),
             dbc.Row([
                 dbc.Col([
-                    html.Div(id='page_layout'),
+                    html.Div(build_page_layout(), id='page_layout'),
                 ], width=12)
             ]),
         ])
     return subjects_report
 
-def build_page_layout(toggle_view_value, sections_dict):
-
-    section1 = sections_dict['section1']
-    section2 = sections_dict['section2']
-    section3 = sections_dict['section3']
-    section4 = sections_dict['section4']
-
-    if toggle_view_value:
-        page_layout = [html.H3('Screening'), section1, html.H3('Study Status'), section2, html.H3('Deviations & Adverse Events'), section3, html.H3('Demographics'), section4]
-    else:
-        page_layout = html.Div([
-                    dcc.Tabs(id='tabs_tables', children=[
-                        dcc.Tab(label='Screening', children=[
-                            html.Div([section1], id='section_1'),
-                        ]),
-                        dcc.Tab(label='Study Status', children=[
-                            html.Div([section2], id='section_2'),
-                        ]),
-                        dcc.Tab(label='Deviations & Adverse Events', children=[
-                            html.Div([section3], id='section_3'),
-                        ]),
-                        dcc.Tab(label='Demographics', children=[
-                            html.Div([section4], id='section_4'),
-                        ]),
-                    ]),
-                    ])
+# Report sections in page order: section key: section title
+report_sections = {'section1': 'Screening', 'section2': 'Study Status', 'section3': 'Deviations & Adverse Events', 'section4': 'Demographics'}
+
+def get_report_section(report_id, section):
+    '''Page content for one section of a report, built the first time it is asked for and then served
+    from the report cache'''
+    if report_id is None:
+        return html.Div("The data for this report is not available at this time.  Please try again later.")
+    report_section = get_or_build_report_part(report_id, section, lambda report_dict: build_report_section(report_dict, section))
+    if report_section is None:
+        return html.Div("This report has been updated.  Please reload the page.")
+    return report_section['section']
+
+def get_report_listing(report_id, table_name):
+    '''Listing (build_listing) of a listing table of a report, or None if the report is not available'''
+    if report_id is None or table_name not in listing_tables:
+        return None
+    section = listing_tables[table_name]
+    report_section = get_or_build_report_part(report_id, section, lambda report_dict: build_report_section(report_dict, section))
+    if report_section is None:
+        return None
+    return report_section['listings'][table_name]
+
+def build_page_layout():
+    '''Tabs and a container per report section. The sections are loaded from the server the first time they
+    are shown (load_report_section); switching tabs or between tabs and the single page view only shows and
+    hides the containers in the browser.'''
+    page_layout = html.Div([
+                dcc.Tabs(id='tabs_tables', value='section1', children=[
+                    dcc.Tab(label=title, value=section) for section, title in report_sections.items()
+                ]),
+                html.Div([
+                    html.Div([
+                        dcc.Store(id={'type': 'section_shown', 'section': section}, data=False),
+                        html.H3(title, id={'type': 'section_title', 'section': section}, style={'display': 'none'}),
+                        dcc.Loading(html.Div(id={'type': 'section_content', 'section': section})),
+                    ], id={'type': 'report_section', 'section': section}, style={'display': 'none'})
+                    for section, title in report_sections.items()
+                ]),
+                ])
     return page_layout
 
-def serve_layout():
-    page_meta_dict, tables_dict, sections_dict, enrollment_dict = {'report_date_msg':''}, {}, {}, {}
-    report_date = datetime.now()
-
+@timed_stage
+def get_clean_frames(subjects_files, snapshot_hash, asset_hash, screening_sites, display_terms_dict, display_terms_dict_multi):
+    '''Get the cleaned subjects, consented and adverse_events dataframes (and the summary table counts) for a
+    snapshot: from the saved frames if this snapshot has been cleaned before, else by patching the changed
+    records into the last cleaned snapshot, else by cleaning the whole snapshot. The frames are returned with
+    compact dtypes (compact_dtypes).'''
+    start_time = time.perf_counter()
+    frames_dict = load_clean_frames(snapshot_hash)
+    if frames_dict is not None:
+        print('Loaded cleaned frames in {:.3f}s'.format(time.perf_counter() - start_time))
+        return frames_dict
+
+    subjects_raw, adverse_effects, record_hashes = load_subjects_files(subjects_files)
+    saved_frames = load_latest_clean_frames(asset_hash)
+    if saved_frames is not None:
+        frames_dict = patch_clean_frames(saved_frames, subjects_raw, adverse_effects, record_hashes, screening_sites, display_terms_dict, display_terms_dict_multi)
+    if frames_dict is not None:
+        print('Loaded json snapshot and patched changed records in {:.3f}s'.format(time.perf_counter() - start_time))
+    else:
+        subjects, consented, adverse_events = clean_subjects(subjects_raw, adverse_effects, screening_sites, display_terms_dict, display_terms_dict_multi)
+        frames_dict = {'subjects': subjects, 'consented': consented, 'adverse_events': adverse_events, 'record_hashes': record_hashes}
+        print('Loaded and cleaned json snapshot in {:.3f}s'.format(time.perf_counter() - start_time))
+
+    clean_memory = get_frames_memory(frames_dict)
+    frames_dict = compact_frames(frames_dict)
+    compact_memory = get_frames_memory(frames_dict)
+    for frame_name in clean_memory:
+        set_gauge('a2cps_frame_bytes', {'frame': frame_name}, compact_memory[frame_name])
+    print('Compacted cleaned frames from {:.2f} MB to {:.2f} MB'.format(sum(clean_memory.values()) / 2**20, sum(compact_memory.values()) / 2**20))
+    if 'table_counts' not in frames_dict:
+        frames_dict['table_counts'] = get_table_counts(frames_dict['subjects'], frames_dict['consented'], frames_dict['adverse_events'])
+    save_clean_frames(snapshot_hash, frames_dict)
+    set_latest_clean_frames(snapshot_hash, asset_hash)
+    return frames_dict
+
+def build_report(subjects_files, snapshot_hash, asset_hash, asset_files, page_meta_dict, report_date):
+    '''Everything needed to build the report sections later on. The sections themselves are built by
+    build_report_section when they are first displayed.'''
+    return {'page_meta_dict': page_meta_dict, 'subjects_files': subjects_files, 'snapshot_hash': snapshot_hash,
+            'asset_hash': asset_hash, 'asset_files': asset_files, 'report_date': report_date}
+
+def build_report_section(report_dict, section):
+    '''Run the data pipeline for one section of a report and return its tables and page content'''
     try:
-    # get data for page
-    # print('time parameters')
-        today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_date)
-        if DATA_SOURCE == 'url':
-            page_meta_dict['report_date_msg'] = report_date_msg
-        elif DATA_SOURCE == 'local':
-            page_meta_dict['report_date_msg'] = 'Report generated from archived data dated ' + local_data_date
-        else:
-            page_meta_dict['report_date_msg'] = 'Data date unclear'
-        page_meta_dict['report_range_msg'] = report_range_msg
-        # print('get data inputs')
-
-        # display_terms, display_terms_dict, display_terms_dict_multi, clean_weekly, consented, screening_data, clean_adverse, centers_df, r_status = get_data_for_page(ASSETS_PATH, display_terms_file, file_url_root, report, report_suffix, mcc_list)
-        display_terms, display_terms_dict, display_terms_dict_multi = load_display_terms(ASSETS_PATH, 'A2CPS_display_terms.csv')
-        screening_sites = pd.read_csv(os.path.join(ASSETS_PATH, 'screening_sites.csv'))
-        # Run Data Calls
-        subjects_json = get_subjects_json(report, report_suffix, file_url_root, source=DATA_SOURCE)
-
-        if subjects_json:
-            # print('subjects_json')
-            subjects, consented, adverse_events = create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi)
+        # The copies of the subjects files may have been pruned since the page was served
+        subjects_files, snapshot_hash = report_dict['subjects_files'], report_dict['snapshot_hash']
+        if not all(os.path.exists(subjects_file) for subjects_file in subjects_files.values()) and load_clean_frames(snapshot_hash) is None:
+            return None
+
+        display_terms, display_terms_dict, display_terms_dict_multi = get_display_terms()
+        screening_sites = get_screening_sites()
+        frames_dict = get_clean_frames(subjects_files, snapshot_hash, report_dict['asset_hash'], screening_sites, display_terms_dict, display_terms_dict_multi)
+        subjects, consented, adverse_events = frames_dict['subjects'], frames_dict['consented'], frames_dict['adverse_events']
+        table_counts = frames_dict['table_counts']
+        today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_dict['report_date'])
+
+        if section == 'section1':
+            tables = get_screening_tables(subjects, consented, display_terms_dict_multi, today, start_report, end_report, table_counts)
+            build_section = build_section1
+        elif section == 'section2':
+            tables = get_study_status_tables(consented, today, table_counts)
+            build_section = build_section2
+        elif section == 'section3':
             screening_centers_df, centers_df = get_centers(subjects, consented, display_terms)
+            tables = get_deviation_and_adverse_event_tables(consented, adverse_events, centers_df, display_terms_dict_multi, today, table_counts)
+            build_section = build_section3
+        else:
+            tables = get_demographics_tables(consented, display_terms_dict)
+            build_section = build_section4
 
-            # print('GET TABLE DATA')
-            table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age = get_tables(today, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df)
+        tables_dict = get_tables_dict(tables)
+        listings = {table_name: build_listing(tables_dict[table_name]) for table_name in tables_dict if table_name in listing_tables}
+        return {'tables_dict': tables_dict, 'listings': listings, 'section': build_section(tables_dict, report_dict['page_meta_dict'])}
 
-            # print('building tables')
-            tables_dict = build_tables_dict(table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age)
+    except Exception as e:
+        traceback.print_exc()
+        return None
 
-            # print('building content')
-            section1, section2, section3, section4 = build_content(tables_dict, page_meta_dict)
+excel_tables_names = ["table1a","table1b", "table2a", "table2b", "table3a", "table3b", "table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age"]
 
-        else:
-            # print('NO subjects_json')
-            no_data_msg = "The data for this report is not available at this time.  Please try again later."
-            section1, section2, section3, section4 = html.Div(no_data_msg), html.Div(no_data_msg), html.Div(no_data_msg), html.Div(no_data_msg)
+@timed_stage
+def build_excel_report(report_dict):
+    '''Write every table of the report to an in-memory excel workbook and return it base64 encoded,
+    as the Download component expects'''
+    try:
+        store = {}
+        for section in report_sections:
+            # Sections not displayed yet are built here and saved with the report along with the workbook
+            if section not in report_dict:
+                report_dict[section] = build_report_section(report_dict, section)
+                if report_dict[section] is None:
+                    return None
+            store.update(report_dict[section]['tables_dict'])
+
+        excel_buffer = io.BytesIO()
+        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
+            for table in excel_tables_names:
+                df = pd.DataFrame(store[table]['data'])
+                # convert multiindex columns and remove the '_'
+                df.columns = [col[1:] if col[0] == '_' else col.replace('_',': ') for col in df.columns]
+                if len(df) == 0 :
+                    df = pd.DataFrame(columns =['No data for this table'])
+                df.to_excel(writer, sheet_name=store[table]['excel_sheet_name'], index = False)
+
+        return base64.b64encode(excel_buffer.getvalue()).decode()
+
+    except Exception as e:
+        traceback.print_exc()
+        return None
 
-            # print('get sections')
-        sections_dict = get_sections_dict_for_store(section1, section2, section3, section4)
+def get_report(report_date):
+    '''Page meta data and report id of the report for the latest snapshot, building the report (context) if
+    it is not cached. The report id is None if there is no snapshot.'''
+    page_meta_dict, report_id = {'report_date_msg':''}, None
 
+    # get data for page
+    # print('time parameters')
+    today, start_report, end_report, report_date_msg, report_range_msg  = get_time_parameters(report_date)
+    if DATA_SOURCE == 'url':
+        page_meta_dict['report_date_msg'] = report_date_msg
+    elif DATA_SOURCE == 'local':
+        page_meta_dict['report_date_msg'] = 'Report generated from archived data dated ' + local_data_date
+    else:
+        page_meta_dict['report_date_msg'] = 'Data date unclear'
+    page_meta_dict['report_range_msg'] = report_range_msg
+    # print('get data inputs')
+
+    # Run Data Calls
+    subjects_files = get_subjects_files(report, report_suffix, file_url_root, source=DATA_SOURCE)
+
+    if subjects_files:
+        # Only the report id goes to the page; each section is built (once per report) when it is first displayed
+        asset_files = [os.path.join(ASSETS_PATH, 'A2CPS_display_terms.csv'), os.path.join(ASSETS_PATH, 'screening_sites.csv')]
+        # The report is built from copies of the bytes hashed, as other workers may replace the subjects files meanwhile
+        snapshot_hash, subjects_files = save_snapshot_files(subjects_files, asset_files)
+        if snapshot_hash is None:
+            return page_meta_dict, report_id
+        asset_hash = get_snapshot_hash({}, asset_files)
+        cache_key = get_report_cache_key(snapshot_hash, report_date, DATA_SOURCE)
+        report_dict = get_or_build_report(cache_key, lambda: build_report(subjects_files, snapshot_hash, asset_hash, asset_files, page_meta_dict, report_date))
+        page_meta_dict, report_id = report_dict['page_meta_dict'], cache_key
+
+    return page_meta_dict, report_id
+
+@timed_stage
+def serve_layout():
+    page_meta_dict, report_id = {'report_date_msg':''}, None
+
+    try:
+        current_report = load_current_report() if REFRESH_INTERVAL > 0 else None
+        if current_report is not None:
+            # The background refresh keeps the current report up to date, so the page does not wait on the datastore
+            page_meta_dict, report_id = dict(current_report['page_meta_dict']), current_report['report_id']
+            page_meta_dict['report_age_msg'] = 'Report built {:%Y-%m-%d %H:%M}, data last checked {:%Y-%m-%d %H:%M}'.format(
+                datetime.fromtimestamp(current_report['built']), datetime.fromtimestamp(current_report['checked']))
+            if flask.has_request_context():
+                flask.g.report_age = time.time() - current_report['built']
+        else:
+            page_meta_dict, report_id = get_report(datetime.now())
         page_layout = html.Div(id='page_layout')
     except Exception as e:
         traceback.print_exc()
         page_layout = html.Div(['There has been a problem accessing the data for this Report.'])
 
+    store_meta = {'report_id': report_id}
+    set_gauge('a2cps_store_bytes', {'store': 'store_meta'}, len(json.dumps(store_meta)))
+
     s_layout = html.Div([
-        dcc.Store(id='store_meta', data = page_meta_dict),
-        dcc.Store(id='store_tables', data = tables_dict),
-        dcc.Store(id='store_sections', data = sections_dict),
-        dcc.Store(id='store_enrollment', data = enrollment_dict),
+        # Sections and tables stay on the server; callbacks look them up by report id
+        dcc.Store(id='store_meta', data = store_meta),
         Download(id="download-dataframe-xlxs"),
         Download(id="download-dataframe-html"),
 
@@ -519,59 +668,254 @@ def test_layout():
 # app.layout = test_layout
 app.layout = serve_layout
 
+# ----------------------------------------------------------------------------
+# SERVER ROUTES
+# ----------------------------------------------------------------------------
+
+@app.server.route('/cache-stats')
+def cache_stats():
+    '''Report cache hit, miss and rebuild counts of all running workers'''
+    return flask.jsonify(get_report_cache_stats())
+
+@app.server.route('/metrics')
+def prometheus_metrics():
+    current_report = load_current_report()
+    if current_report is not None:
+        set_gauge('a2cps_report_age_seconds', {'since': 'built'}, time.time() - current_report['built'])
+        set_gauge('a2cps_report_age_seconds', {'since': 'checked'}, time.time() - current_report['checked'])
+    for subjects_file in pathlib.Path(DATA_PATH).glob('subjects-*-latest.json'):
+        mcc = subjects_file.name.split('-')[1]
+        set_gauge('a2cps_snapshot_age_seconds', {'mcc': mcc}, time.time() - os.path.getmtime(subjects_file))
+    flush_metrics()
+    return flask.Response(get_metrics_text(), mimetype='text/plain; version=0.0.4')
+
+@app.server.route('/ready')
+def ready():
+    '''Readiness probe: 503 until the preloaded report is built. A worker that started without it (the
+    preload failed, e.g. the datastore was down) builds it again in the background, so the probe answers
+    at once.'''
+    if not report_status['ready']:
+        start_report_preload()
+    return flask.jsonify(report_status), 200 if report_status['ready'] else 503
+
+def get_request_endpoint():
+    ''''layout' for the page layout request, the output (e.g. 'download-dataframe-xlxs.data') for a callback
+    request, None for other requests'''
+    if flask.request.path.endswith('_dash-layout'):
+        return 'layout'
+    if flask.request.path.endswith('_dash-update-component'):
+        return (flask.request.get_json(silent=True) or {}).get('output', 'unknown')
+    return None
+
+# Time the page layout and each callback, labelled with the callback's output, and profile them on request
+@app.server.before_request
+def start_request_timer():
+    start_refresh_scheduler()
+    flask.g.request_start_time = time.perf_counter()
+    flask.g.request_profile = None
+    if get_request_endpoint() is not None and is_profiling_requested(flask.request.headers):
+        flask.g.request_profile = start_profile()
+
+@app.server.after_request
+def record_request_metrics(response):
+    try:
+        endpoint = get_request_endpoint()
+        if endpoint is not None:
+            if flask.g.get('request_profile') is not None:
+                profile_name = save_profile(flask.g.request_profile, endpoint)
+                flask.g.request_profile = None
+                if profile_name:
+                    response.headers['X-Profile-File'] = profile_name
+            if flask.g.get('report_age') is not None:
+                response.headers['Age'] = str(int(flask.g.report_age))
+            observe_histogram('a2cps_request_seconds', {'endpoint': endpoint}, time.perf_counter() - flask.g.request_start_time)
+            set_gauge('a2cps_response_bytes', {'endpoint': endpoint}, response.calculate_content_length() or 0)
+            flush_metrics()
+    except Exception as e:
+        traceback.print_exc()
+    return response
+
+@app.server.teardown_request
+def stop_request_profile(exception):
+    '''Stop and save the profile of a request that ended without a response to record it on (e.g. the view
+    raised), so the profiler does not stay enabled on the thread'''
+    if flask.g.get('request_profile') is not None:
+        save_profile(flask.g.request_profile, get_request_endpoint() or 'unknown')
+        flask.g.request_profile = None
+
 # ----------------------------------------------------------------------------
 # DATA CALLBACKS
 # ----------------------------------------------------------------------------
 
-# Use toggle to display either tabs or single page LAYOUT
-@app.callback(Output("page_layout","children"), Input('toggle-view',"value"),State('store_sections', 'data'))
-def set_page_layout(value, sections):
-    return build_page_layout(value, sections)
+# Use toggle to display either tabs or single page LAYOUT. Runs in the browser: it shows the open tab's section
+# (or every section, with titles, on the single page) and marks sections shown for the first time, which
+# load_report_section then loads once.
+clientside_callback(
+    """
+    function(single_page, tab, shown, section_ids) {
+        const hidden = {'display': 'none'};
+        const visible = section_ids.map(section_id => single_page || section_id.section === tab);
+        return [
+            single_page ? hidden : {},
+            visible.map(is_visible => is_visible ? {} : hidden),
+            section_ids.map(() => single_page ? {} : hidden),
+            visible.map((is_visible, i) => is_visible && !shown[i] ? true : window.dash_clientside.no_update)
+        ];
+    }
+    """,
+    Output('tabs_tables', 'style'),
+    Output({'type': 'report_section', 'section': ALL}, 'style'),
+    Output({'type': 'section_title', 'section': ALL}, 'style'),
+    Output({'type': 'section_shown', 'section': ALL}, 'data'),
+    Input('toggle-view', 'value'),
+    Input('tabs_tables', 'value'),
+    State({'type': 'section_shown', 'section': ALL}, 'data'),
+    State({'type': 'section_shown', 'section': ALL}, 'id'),
+)
+
+# Build the content of a section the first time it is shown
+@app.callback(Output({'type': 'section_content', 'section': MATCH}, 'children'),
+              Input({'type': 'section_shown', 'section': MATCH}, 'data'),
+              State({'type': 'section_shown', 'section': MATCH}, 'id'),
+              State('store_meta', 'data'),
+              prevent_initial_call=True)
+def load_report_section(shown, section_id, page_meta_dict):
+    if not shown:
+        raise PreventUpdate
+    return get_report_section(page_meta_dict['report_id'], section_id['section'])
+
+# Page, sort and filter a listing table on the server, sending only the page shown. A new filter or sort
+# goes back to the first page.
+@app.callback(Output({'type': 'listing_table', 'table': MATCH}, 'data'),
+              Output({'type': 'listing_table', 'table': MATCH}, 'page_count'),
+              Output({'type': 'listing_table', 'table': MATCH}, 'page_current'),
+              Input({'type': 'listing_table', 'table': MATCH}, 'page_current'),
+              Input({'type': 'listing_table', 'table': MATCH}, 'page_size'),
+              Input({'type': 'listing_table', 'table': MATCH}, 'sort_by'),
+              Input({'type': 'listing_table', 'table': MATCH}, 'filter_query'),
+              State({'type': 'listing_table', 'table': MATCH}, 'id'),
+              State('store_meta', 'data'),
+              prevent_initial_call=True)
+def update_listing_page(page_current, page_size, sort_by, filter_query, table_id, page_meta_dict):
+    listing = get_report_listing(page_meta_dict['report_id'], table_id['table'])
+    if listing is None:
+        raise PreventUpdate
+    if any(trigger['prop_id'].endswith(('.sort_by', '.filter_query')) for trigger in callback_context.triggered):
+        records, page_count = get_listing_page(listing, 0, page_size or LISTING_PAGE_SIZE, sort_by, filter_query)
+        return records, page_count, 0
+    records, page_count = get_listing_page(listing, page_current or 0, page_size or LISTING_PAGE_SIZE, sort_by, filter_query)
+    return records, page_count, no_update
 
 # Create excel spreadsheel
 @app.callback(
         Output("download-dataframe-xlxs", "data"),
         Input("btn_xlxs", "n_clicks"),
-        State("store_tables","data"),
+        State("store_meta","data"),
         )
-def click_excel(n_clicks,store):
+def click_excel(n_clicks,page_meta_dict):
     if n_clicks == 0:
         raise PreventUpdate
-    if store:
-        try:
-            # msg =  html.Div(json.dumps(store))
-            today = datetime.now().strftime('%Y_%m_%d')
-            download_filename = datetime.now().strftime('%Y_%m_%d') + '_a2cps_weekly_report_data.xlsx'
-            table_keys = store.keys()
-
-            writer = pd.ExcelWriter(download_filename, engine='xlsxwriter')
-
-            tables_names = ["table1a","table1b", "table2a", "table2b", "table3a", "table3b", "table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age"]
-            for table in tables_names:
-                excel_sheet_name = store[table]['excel_sheet_name']
-                df = pd.DataFrame(store[table]['data'])
-
-                # convert multiindex columns and remove the '_'
-                new_cols = []
-                for i in list(df.columns):
-                    if i[0] == '_':
-                        new_cols.append(i[1:])
-                    else:
-                        new_cols.append(i.replace('_',': '))
-                df.columns = new_cols
+    if page_meta_dict['report_id']:
+        # The workbook is built once per report and then served from the report cache
+        excel_content = get_or_build_report_part(page_meta_dict['report_id'], 'excel', build_excel_report)
+        if excel_content is None:
+            return None
+        download_filename = datetime.now().strftime('%Y_%m_%d') + '_a2cps_weekly_report_data.xlsx'
+        return dict(content=excel_content, filename=download_filename, mime_type=None, base64=True)
 
-                if len(df) == 0 :
-                    df = pd.DataFrame(columns =['No data for this table'])
-                df.to_excel(writer, sheet_name=excel_sheet_name, index = False)
 
-            writer.save()
-            excel_file =  send_file(writer, download_filename)
-            return excel_file
+# ----------------------------------------------------------------------------
+# PRELOAD AND BACKGROUND REFRESH
+# ----------------------------------------------------------------------------
+# With PRELOAD_REPORT set, the report for the latest snapshot is built in full (every section and the
+# Excel workbook) when the app is imported. Under gunicorn --preload that is the master process, so the
+# workers fork with the report in memory (report_parts_memory) and share those pages copy-on-write.
+# gc.freeze() then moves everything built so far out of reach of the garbage collector, so collections
+# in the workers do not write to, and so copy, the shared pages.
+#
+# With REFRESH_INTERVAL set, every worker runs a refresh thread. Whichever worker finds the current report
+# due for a check (and takes the refresh lock) fetches the snapshot, builds the new report in full if the
+# snapshot or the report date changed, and then makes it the current report (set_current_report). Pages
+# are served the current report in the meantime.
+
+report_status = {'ready': not PRELOAD_REPORT, 'report_id': None}
+refresh_scheduler = {'pid': None}
+report_preload = {'thread': None}
+report_preload_lock = threading.Lock()
+
+def build_full_report(report_date):
+    '''Build the report for the latest snapshot in full: the report context, every section and the Excel
+    workbook. Returns the page meta data and the report id, which is None if the report was not built.'''
+    page_meta_dict, report_id = get_report(report_date)
+    if report_id is None:
+        print('No snapshot to build the report from')
+        return page_meta_dict, None
+    for section in report_sections:
+        if get_or_build_report_part(report_id, section, lambda report_dict: build_report_section(report_dict, section)) is None:
+            print('Could not build {} of report {}'.format(section, report_id))
+            return page_meta_dict, None
+    get_or_build_report_part(report_id, 'excel', build_excel_report)
+    return page_meta_dict, report_id
+
+def refresh_report():
+    '''Build the report for the latest snapshot and today's date if it is not built yet, and make it the current
+    report. Returns the current report record, or None if the report could not be built.'''
+    try:
+        start_time = time.perf_counter()
+        page_meta_dict, report_id = build_full_report(datetime.now())
+        if report_id is None:
+            return None
+        current_report = load_current_report()
+        if current_report is not None and current_report['report_id'] == report_id:
+            return set_current_report(report_id, page_meta_dict, current_report['built'])
+        print('Built report {} in {:.3f}s, now the current report'.format(report_id, time.perf_counter() - start_time))
+        return set_current_report(report_id, page_meta_dict)
+    except Exception as e:
+        traceback.print_exc()
+        return None
 
+def preload_report():
+    '''Build the report for the latest snapshot in this process. Returns True if it was built.'''
+    start_time = time.perf_counter()
+    current_report = refresh_report()
+    if current_report is None:
+        return False
+    report_status.update({'ready': True, 'report_id': current_report['report_id']})
+    print('Preloaded report {} in {:.3f}s'.format(current_report['report_id'], time.perf_counter() - start_time))
+    return True
+
+def start_report_preload():
+    '''Build the preloaded report in a thread of this process, unless it is built or being built already.
+    Threads do not survive the fork from the master, so a worker whose master could not build it starts its own.'''
+    with report_preload_lock:
+        if report_status['ready'] or (report_preload['thread'] is not None and report_preload['thread'].is_alive()):
+            return
+        report_preload['thread'] = threading.Thread(target=preload_report, name='report_preload', daemon=True)
+        report_preload['thread'].start()
+
+def run_refresh_scheduler(interval = REFRESH_INTERVAL, check_interval = 30):
+    '''Refresh the current report every interval seconds. Every worker runs this; the refresh lock and the
+    time the current report was last checked keep the workers from refreshing it more often.'''
+    while True:
+        try:
+            with try_cache_lock('refresh') as locked:
+                current_report = load_current_report()
+                if locked and (current_report is None or time.time() - current_report['checked'] >= interval):
+                    refresh_report()
         except Exception as e:
             traceback.print_exc()
-            return None
-
+        time.sleep(min(interval, check_interval))
+
+def start_refresh_scheduler():
+    '''Start the refresh thread of this process, if the refresh is on and the thread is not running yet. The
+    thread is started on a worker's first request, as threads do not survive the fork from the master.'''
+    if REFRESH_INTERVAL > 0 and refresh_scheduler['pid'] != os.getpid():
+        refresh_scheduler['pid'] = os.getpid()
+        threading.Thread(target=run_refresh_scheduler, name='report_refresh', daemon=True).start()
+
+if PRELOAD_REPORT:
+    preload_report()
+    gc.freeze()
 
 # ----------------------------------------------------------------------------
 # RUN APPLICATION
@@ -37,7 +37,39 @@ def get_django_user():
 # ----------------------------------------------------------------------------
 # CONFIG SETTINGS
 # ----------------------------------------------------------------------------
-DATA_PATH = pathlib.Path(__file__).parent.joinpath("data")
-ASSETS_PATH = pathlib.Path(__file__).parent.joinpath("assets")
+DATA_PATH = pathlib.Path(os.environ.get("DATA_PATH", pathlib.Path(__file__).parent.joinpath("data")))
+ASSETS_PATH = pathlib.Path(os.environ.get("ASSETS_PATH", pathlib.Path(__file__).parent.joinpath("assets")))
 REQUESTS_PATHNAME_PREFIX = os.environ.get("REQUESTS_PATHNAME_PREFIX", "/")
-DATA_SOURCE = 'url' # switch to url for API, 'local' for local data files
+DATA_SOURCE = os.environ.get("DATA_SOURCE", 'url') # switch to url for API, 'local' for local data files
+
+# Directory for the processed-report cache shared by all gunicorn workers
+REPORT_CACHE_PATH = pathlib.Path(os.environ.get("REPORT_CACHE_PATH", "/tmp/a2cps_report_cache"))
+REPORT_CACHE_MAX_ENTRIES = int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", 8))
+# Number of report sections each worker keeps in memory
+REPORT_MEMORY_MAX_ENTRIES = int(os.environ.get("REPORT_MEMORY_MAX_ENTRIES", 16))
+
+# Build the report for the latest snapshot when the app is imported (the gunicorn master under --preload),
+# so the workers start with it in memory; /ready fails until it is built
+PRELOAD_REPORT = os.environ.get("PRELOAD_REPORT", "").lower() in ("1", "true", "yes")
+
+# Background refresh: every REFRESH_INTERVAL seconds one worker checks the datastore and, when the snapshot or
+# the report date has changed, builds the new report and then swaps it in. Pages are served the current
+# report without waiting on the datastore. 0 turns the refresh off: each page load checks the datastore.
+REFRESH_INTERVAL = int(os.environ.get("REFRESH_INTERVAL", 0))
+
+# Rows per page of the listing tables (decline comments, rescinded consent, early termination, deviation and
+# adverse event descriptions), which are paged, sorted and filtered on the server
+LISTING_PAGE_SIZE = int(os.environ.get("LISTING_PAGE_SIZE", 25))
+
+# Directory where each gunicorn worker writes its metrics for the /metrics route
+METRICS_PATH = pathlib.Path(os.environ.get("METRICS_PATH", REPORT_CACHE_PATH.joinpath("metrics")))
+
+# Profiling of single layout and callback requests: every request if PROFILE_REQUESTS is set, otherwise
+# requests with an X-Profile header matching PROFILE_TOKEN
+PROFILE_REQUESTS = os.environ.get("PROFILE_REQUESTS", "").lower() in ("1", "true", "yes")
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_PATH = pathlib.Path(os.environ.get("PROFILE_PATH", "/tmp/a2cps_profiles"))
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", 30))
+
+# Snapshots where more than this fraction of records changed are cleaned in full instead of patched
+REPORT_DELTA_MAX_FRACTION = float(os.environ.get("REPORT_DELTA_MAX_FRACTION", 0.25))
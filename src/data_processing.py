@@ -5,16 +5,19 @@ import traceback
 import os # Operating system library
 import pathlib # file paths
 import json
+import hashlib
 import requests
 import math
+from types import MappingProxyType
 import numpy as np
 import pandas as pd # Dataframe manipulations
-import sqlite3
 import datetime
 from datetime import datetime, timedelta
 
 # import local modules
 from config_settings import *
+from datastore_loading import *
+from metrics import *
 
 # ----------------------------------------------------------------------------
 # HELPER FUNCTIONS
@@ -96,6 +99,53 @@ def load_display_terms(ASSETS_PATH, display_terms_file):
         traceback.print_exc()
         return None
 
+# The asset files change only when they are replaced, so each process compiles them once and again only when
+# a file's modification time or size changes. The lookups are shared by every caller in the process: the
+# display terms dictionaries are read-only mappings, and the dataframes must not be changed in place.
+# A file can be compiled into more than one lookup, so lookups are kept by file and compile function.
+
+asset_lookups = {}
+
+def get_file_stamp(file_path):
+    file_stat = os.stat(file_path)
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+def get_asset_lookup(asset_file, compile_lookup):
+    '''compile_lookup(asset_file), compiled once per process and again when the file changes'''
+    file_stamp = get_file_stamp(asset_file)
+    cached = asset_lookups.get((asset_file, compile_lookup))
+    if cached is not None and cached[0] == file_stamp:
+        return cached[1]
+    lookup = compile_lookup(asset_file)
+    if lookup is not None:
+        asset_lookups[(asset_file, compile_lookup)] = (file_stamp, lookup)
+    return lookup
+
+def compile_display_terms(display_terms_file):
+    display_terms_lookup = load_display_terms(None, display_terms_file)
+    if display_terms_lookup is None:
+        return None
+    display_terms, display_terms_dict, display_terms_dict_multi = display_terms_lookup
+    return display_terms, MappingProxyType(display_terms_dict), MappingProxyType(display_terms_dict_multi)
+
+@timed_stage
+def get_display_terms(assets_path = ASSETS_PATH, display_terms_file = 'A2CPS_display_terms.csv'):
+    '''The display terms and display dictionaries (as load_display_terms returns them) of this process'''
+    return get_asset_lookup(os.path.join(assets_path, display_terms_file), compile_display_terms)
+
+@timed_stage
+def get_screening_sites(assets_path = ASSETS_PATH, screening_sites_file = 'screening_sites.csv'):
+    '''The screening sites dataframe of this process'''
+    return get_asset_lookup(os.path.join(assets_path, screening_sites_file), pd.read_csv)
+
+def compile_site_enrollment_expectations(screening_sites_file):
+    return get_site_enrollment_expectations(get_asset_lookup(screening_sites_file, pd.read_csv))
+
+@timed_stage
+def get_screening_site_expectations(assets_path = ASSETS_PATH, screening_sites_file = 'screening_sites.csv'):
+    '''The expected enrollment by screening site (get_site_enrollment_expectations) of this process'''
+    return get_asset_lookup(os.path.join(assets_path, screening_sites_file), compile_site_enrollment_expectations)
+
 def get_display_dictionary(display_terms, api_field, api_value, display_col):
     '''from a dataframe with the table display information, create a dictionary by field to match the database
     value to a value for use in the UI '''
@@ -116,40 +166,237 @@ def get_display_dictionary(display_terms, api_field, api_value, display_col):
         traceback.print_exc()
         return None
 
+def get_display_key(value):
+    '''Normalise a coded value so numeric codes match whether they are stored as numbers or strings'''
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    if isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+def get_display_decoder(display_terms_dict):
+    '''Compile the display terms dictionary of lookup dataframes into a dictionary of
+    field: {code: display text} mappings for use with decode_display_terms'''
+    display_decoder = {}
+    for field, term_df in display_terms_dict.items():
+        display_decoder[field] = {get_display_key(code): display for code, display in zip(term_df[field], term_df[field + '_display'])}
+    return display_decoder
+
+def decode_display_terms(df, display_decoder):
+    '''Add a [field]_display column for every field in display_decoder that is in the dataframe,
+    translating the database values in a single pass without merging on the lookup tables'''
+    display_cols = {}
+    for field, mapping in display_decoder.items():
+        if field in df.columns:
+            codes = df[field]
+            if not pd.api.types.is_numeric_dtype(codes):
+                numeric_codes = pd.to_numeric(codes, errors='coerce')
+                codes = numeric_codes.astype(object).where(numeric_codes.notnull(), codes)
+            display_cols[field + '_display'] = codes.map(mapping)
+    if not display_cols:
+        return df
+    return pd.concat([df, pd.DataFrame(display_cols, index=df.index)], axis=1)
+
 # ----------------------------------------------------------------------------
 # DATA LOADING
 # ----------------------------------------------------------------------------
-def get_subjects_json(report, report_suffix, file_url_root=None, source='local', mcc_list =[1,2], DATA_PATH = DATA_PATH):
+@timed_stage
+def get_subjects_files(report, report_suffix, file_url_root=None, source='local', mcc_list =[1,2], DATA_PATH = DATA_PATH):
+    '''Get the local subjects json file for each mcc. If source is 'url' the files are first refreshed from the
+    datastore; the last good download of each file is kept in DATA_PATH and used if the datastore fails.'''
     print(source)
     try:
-        subjects_json = {}
-        # Read files into json
+        subjects_files = {}
         if source == 'url':
+            snapshot_sources = {}
             for mcc in mcc_list:
-                print(mcc)
                 json_url = '/'.join([file_url_root, report,report_suffix.replace('[mcc]',str(mcc))])
-                print(json_url)
-                r = requests.get(json_url)
-                print(r.status_code)
-                if r.status_code == 200:
-                # TO DO: add an else statement to use local files if the request fails
-                    mcc_json = r.json()
-                    subjects_json[mcc] = mcc_json
+                snapshot_file = os.path.join(DATA_PATH, ''.join(['subjects-',str(mcc),'-latest.json']))
+                snapshot_sources[mcc] = (json_url, snapshot_file)
+            mcc_files, fetch_status = fetch_json_snapshots(snapshot_sources, parse=False)
+            print(fetch_status)
+            for mcc, status in fetch_status.items():
+                inc_counter('a2cps_fetch_total', {'mcc': mcc, 'status': status})
+                if status in ('snapshot', 'unavailable'):
+                    inc_counter('a2cps_fetch_errors_total', {'mcc': mcc})
+            for mcc in mcc_list:
+                if mcc_files[mcc] is not None:
+                    subjects_files[mcc] = mcc_files[mcc]
         else:
             for mcc in mcc_list:
                 mcc_filename = ''.join(['subjects-',str(mcc),'-latest.json'])
-                print(mcc_filename)
-                print(DATA_PATH)
-                mcc_file = os.path.join(DATA_PATH, mcc_filename)
-                print(mcc_file)
-                with open(mcc_file, 'r') as f:
-                    subjects_json[mcc] = json.load(f)
+                subjects_files[mcc] = os.path.join(DATA_PATH, mcc_filename)
+        return subjects_files
+
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+@timed_stage
+def get_subjects_json(report, report_suffix, file_url_root=None, source='local', mcc_list =[1,2], DATA_PATH = DATA_PATH):
+    try:
+        subjects_json = {}
+        # Read files into json
+        subjects_files = get_subjects_files(report, report_suffix, file_url_root, source, mcc_list, DATA_PATH)
+        for mcc in subjects_files:
+            with open(subjects_files[mcc], 'r') as f:
+                subjects_json[mcc] = json.load(f)
         return subjects_json
 
     except Exception as e:
         traceback.print_exc()
         return None
 
+def iter_json_object_items(chunks, object_pairs_hook = None, with_text = False):
+    '''Walk the key: value pairs of a top level json object from an iterable of text chunks (a file or
+    response stream), decoding one value at a time so the whole document is never held in memory.
+    If with_text is True the raw json text of each value is yielded as well: (key, value, text).'''
+    decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+    chunks = iter(chunks)
+    buffer, pos, eof = '', 0, False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = next(chunks, '')
+        if chunk == '':
+            eof = True
+        # drop the part of the buffer that has already been decoded
+        buffer, pos = buffer[pos:] + chunk, 0
+
+    def next_char():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos] if pos < len(buffer) else ''
+            read_more()
+
+    def decode_next():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # A value that runs to the end of the buffer may be cut off (e.g. a number), so read on to be sure
+                if end < len(buffer) or eof:
+                    # pos only moves once the value is decoded, so the value's text starts at pos
+                    text = buffer[pos:end]
+                    pos = end
+                    return value, text
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    if next_char() != '{':
+        raise ValueError('Expected a json object')
+    pos += 1
+    while True:
+        c = next_char()
+        if c == ',':
+            pos += 1
+            c = next_char()
+        if c == '}':
+            return
+        if c == '':
+            raise ValueError('Unexpected end of json object')
+        key, key_text = decode_next()
+        if next_char() != ':':
+            raise ValueError('Expected : after key ' + str(key))
+        pos += 1
+        next_char()
+        value, text = decode_next()
+        if with_text:
+            yield key, value, text
+        else:
+            yield key, value
+
+def read_file_chunks(file, chunk_size = 1 << 20):
+    return iter(lambda: file.read(chunk_size), '')
+
+def append_record_columns(columns, record, n_rows):
+    '''Append the values of a record to a dictionary of column lists that already hold n_rows values.
+    Columns first seen in this record are back-filled, and columns missing from it are padded, with nan.'''
+    for col, value in record.items():
+        if col not in columns:
+            columns[col] = [np.nan] * n_rows
+        columns[col].append(value)
+    for col_values in columns.values():
+        if len(col_values) == n_rows:
+            col_values.append(np.nan)
+
+def is_blank(value):
+    return type(value) is str and (value == '' or value.isspace())
+
+def get_record_hash(record_text):
+    return hashlib.blake2b(record_text.encode('utf-8'), digest_size=16).hexdigest()
+
+def load_subjects_file(subjects_file, mcc, intern_pool = None, max_intern_length = 32, adverse_effects_col = 'adverse_effects'):
+    '''Stream one subjects json file into a dataframe, building columns directly from the records.
+    Short strings (codes, 'N/A', site names) are interned through intern_pool so repeated values share
+    one object.
+
+    The nested adverse effects objects ({instance: {field: value}}) are flattened as they are read into
+    a second dataframe with one row per record and instance, with blank strings stored as nan.
+    A hash of each record's json text is returned in a third dataframe (mcc, record_id, record_hash)
+    so records that changed between snapshots can be found.'''
+    if intern_pool is None:
+        intern_pool = {}
+
+    def intern_pairs(pairs):
+        record = {}
+        for k, v in pairs:
+            if type(v) is str and len(v) <= max_intern_length:
+                v = intern_pool.setdefault(v, v)
+            record[intern_pool.setdefault(k, k)] = v
+        return record
+
+    record_ids, record_hashes, columns = [], [], {}
+    ae_index_cols, ae_columns = {'index': [], 'main_record_id': [], 'mcc': [], 'instance': []}, {}
+    with open(subjects_file, 'r') as f:
+        for record_id, record, record_text in iter_json_object_items(read_file_chunks(f), intern_pairs, with_text=True):
+            adverse_effects = record.pop(adverse_effects_col, None)
+            append_record_columns(columns, record, len(record_ids))
+            record_ids.append(record_id)
+            record_hashes.append(get_record_hash(record_text))
+
+            if adverse_effects:
+                main_record_id = record.get('main_record_id', np.nan)
+                for instance, ae_record in adverse_effects.items():
+                    ae_record = {col: (np.nan if is_blank(value) else value) for col, value in ae_record.items()}
+                    append_record_columns(ae_columns, ae_record, len(ae_index_cols['index']))
+                    ae_index_cols['index'].append(record_id)
+                    ae_index_cols['main_record_id'].append(main_record_id)
+                    ae_index_cols['mcc'].append(mcc)
+                    ae_index_cols['instance'].append(instance)
+
+    subjects_raw = pd.DataFrame(dict({'index': record_ids}, **columns), dtype=object)
+    subjects_raw['mcc'] = mcc
+    adverse_effects = pd.concat([pd.DataFrame(ae_index_cols), pd.DataFrame(ae_columns, dtype=object)], axis=1)
+    record_hashes = pd.DataFrame({'mcc': mcc, 'record_id': record_ids, 'record_hash': record_hashes})
+
+    return subjects_raw, adverse_effects, record_hashes
+
+@timed_stage
+def load_subjects_files(subjects_files):
+    '''Stream the subjects json files for all mccs into a single raw subjects dataframe, a dataframe
+    of adverse effects with one row per instance and a dataframe of record hashes, with a string pool
+    shared across files'''
+    intern_pool = {}
+    subjects_list, adverse_effects_list, record_hashes_list = [], [], []
+    for mcc in subjects_files:
+        mcc_subjects, mcc_adverse_effects, mcc_record_hashes = load_subjects_file(subjects_files[mcc], mcc, intern_pool)
+        subjects_list.append(mcc_subjects)
+        adverse_effects_list.append(mcc_adverse_effects)
+        record_hashes_list.append(mcc_record_hashes)
+    subjects_raw = pd.concat(subjects_list, ignore_index=True)
+    adverse_effects = pd.concat(adverse_effects_list, ignore_index=True)
+    adverse_effects = adverse_effects.apply(pd.to_numeric, errors='ignore')
+    record_hashes = pd.concat(record_hashes_list, ignore_index=True)
+    return subjects_raw, adverse_effects, record_hashes
 
 # ----------------------------------------------------------------------------
 # DATA CLEANING
@@ -168,6 +415,7 @@ def combine_mcc_json(mcc_json):
 
     return df
 
+@timed_stage
 def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, display_terms_dict_multi, drop_cols_list =['adverse_effects']):
     '''Take the raw subjects data frame and clean it up. Note that apis don't pass datetime columns well, so
     these should be converted to datetime by the receiver.
@@ -178,13 +426,30 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
         subjects_raw = combine_mcc_json(subjects_json)
         subjects_raw.reset_index(drop=True, inplace=True)
 
+        adverse_effects = extract_adverse_effects_data(subjects_raw)
+
+        return clean_subjects(subjects_raw, adverse_effects, screening_sites, display_terms_dict, display_terms_dict_multi, drop_cols_list)
+
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+@timed_stage
+def clean_subjects(subjects_raw, adverse_effects, screening_sites, display_terms_dict, display_terms_dict_multi, drop_cols_list =['adverse_effects'], text_cols = None):
+    '''Clean the raw subjects dataframe and the adverse effects rows (from load_subjects_files, or
+    combine_mcc_json and extract_adverse_effects_data). Columns listed in text_cols (a dictionary of
+    'subjects' / 'adverse_events': column list) are not coerced to numbers; this is used when cleaning a
+    few records of a snapshot in which those columns are text.'''
+    if text_cols is None:
+        text_cols = {}
+    try:
         #--- Clean up subjects (move to own function?)
         subjects = subjects_raw.copy()
         # Rename 'index' to 'record_id'
         subjects.rename(columns={"index": "record_id"}, inplace = True)
 
         # Drop adverse events column
-        subjects = subjects.drop(columns=drop_cols_list)
+        subjects = subjects.drop(columns=drop_cols_list, errors='ignore')
         # Convert all string 'N/A' values to nan values
         subjects = subjects.replace('N/A', np.nan)
 
@@ -194,16 +459,14 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
             subjects.loc[(subjects.dem_race.str.contains('|', regex=False, na=False)),'dem_race']='8'
 
         # Coerce numeric values to enable merge
-        subjects = subjects.apply(pd.to_numeric, errors='ignore')
-
-        # Merge columns on the display terms dictionary to convert from database terminology to user terminology
-        for i in display_terms_dict.keys():
-            if i in subjects.columns: # Merge columns if the column exists in the dataframe
-                display_terms = display_terms_dict[i]
-                if subjects[i].dtype == np.float64:
-                    # for display columns where data is numeric, merge on display dictionary, treating cols as floats to handle nas
-                    display_terms[i] = display_terms[i].astype('float64')
-                subjects = subjects.merge(display_terms, how='left', on=i)
+        if text_cols.get('subjects'):
+            numeric_cols = subjects.columns.difference(text_cols['subjects'], sort=False)
+            subjects[numeric_cols] = subjects[numeric_cols].apply(pd.to_numeric, errors='ignore')
+        else:
+            subjects = subjects.apply(pd.to_numeric, errors='ignore')
+
+        # Add display columns to convert from database terminology to user terminology
+        subjects = decode_display_terms(subjects, get_display_decoder(display_terms_dict))
         #------
 
 
@@ -218,7 +481,7 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
         consented = get_consented_subjects(subjects)
 
         # Extract adverse events data
-        adverse_events = clean_adverse_events(extract_adverse_effects_data(subjects_raw), consented, display_terms_dict_multi)
+        adverse_events = clean_adverse_events(adverse_effects, consented, display_terms_dict_multi, text_cols.get('adverse_events'))
 
         return subjects, consented, adverse_events
 
@@ -226,32 +489,38 @@ def create_clean_subjects(subjects_json, screening_sites, display_terms_dict, di
         traceback.print_exc()
         return None
 
-def add_screening_site(screening_sites, df, id_col):
-    # Get dataframes
-    ids = df.loc[:, [id_col]]
+def get_screening_site_ranges(screening_sites):
+    '''Sort the screening sites by the start of their record id range so ids can be assigned with searchsorted'''
+    return screening_sites.sort_values('record_id_start', kind='mergesort').reset_index(drop=True)
 
-    # open sql connection to create new datarframe with record_id paired to screening site
-    conn = sqlite3.connect(':memory:')
-    ids.to_sql('ids', conn, index=False)
-    screening_sites.to_sql('ss', conn, index=False)
+def add_screening_site(screening_sites, df, id_col, site_ranges = None):
+    '''Add the screening site, site and surgery type for the range each record id falls in.
+    Records with ids outside every range are dropped (and reported).'''
+    if site_ranges is None:
+        site_ranges = get_screening_site_ranges(screening_sites)
+    site_cols = ['screening_site', 'site', 'surgery_type', 'record_id_start', 'record_id_end']
 
-    sql_qry = f'''
-    select {id_col}, screening_site, site, surgery_type, record_id_start, record_id_end
-    from ids
-    join ss on
-    ids.{id_col} between ss.record_id_start and ss.record_id_end
-    '''
-    sites = pd.read_sql_query(sql_qry, conn)
-    conn.close()
+    # Find the last range starting at or before each id, then check the id is before the end of that range
+    ids = pd.to_numeric(df[id_col], errors='coerce').to_numpy(dtype='float64')
+    range_index = np.searchsorted(site_ranges['record_id_start'].to_numpy(), ids, side='right') - 1
+    range_index = np.clip(range_index, 0, None)
+    in_range = (ids >= site_ranges['record_id_start'].to_numpy()[range_index]) & (ids <= site_ranges['record_id_end'].to_numpy()[range_index])
 
-    df = sites.merge(df, how='left', on=id_col)
+    if not in_range.all():
+        missing_ids = df.loc[~in_range, id_col].tolist()
+        print('{} records outside all screening site ranges: {}'.format(len(missing_ids), missing_ids[:20]))
+
+    sites = site_ranges.loc[range_index[in_range], site_cols].reset_index(drop=True)
+    df = df[in_range].reset_index(drop=True)
+    df = pd.concat([df[[id_col]], sites, df.drop(columns=id_col)], axis=1)
 
     return df
 
 def get_consented_subjects(subjects_with_screening_site):
     '''Get the consented patients from subjects dataframe with screening sites added'''
     consented = subjects_with_screening_site[subjects_with_screening_site.obtain_date.notnull()].copy()
-    consented['treatment_site'] = consented.apply(lambda x: use_b_if_not_a(x['sp_data_site_display'],x['redcap_data_access_group_display']), axis=1)
+    # Use the treatment site if recorded, otherwise the redcap data access group
+    consented['treatment_site'] = consented['sp_data_site_display'].combine_first(consented['redcap_data_access_group_display'])
     consented['treatment_site_type'] = consented['treatment_site'] + "/" + consented['surgery_type']
     return consented
 
@@ -291,15 +560,18 @@ def extract_adverse_effects_data(subjects_data, adverse_effects_col = 'adverse_e
     multi = multi[new_col_order]
     return multi
 
-def clean_adverse_events(adverse_events, consented, display_terms_dict_multi):
+def clean_adverse_events(adverse_events, consented, display_terms_dict_multi, text_cols = None):
     try:
         # Coerce to numeric
-        multi_data = adverse_events.apply(pd.to_numeric, errors='ignore')
+        if text_cols:
+            multi_data = adverse_events.copy()
+            numeric_cols = multi_data.columns.difference(text_cols, sort=False)
+            multi_data[numeric_cols] = multi_data[numeric_cols].apply(pd.to_numeric, errors='ignore')
+        else:
+            multi_data = adverse_events.apply(pd.to_numeric, errors='ignore')
 
         # Convert numeric values to display values using dictionary
-        for i in display_terms_dict_multi.keys():
-            if i in multi_data.columns:
-                multi_data = multi_data.merge(display_terms_dict_multi[i], how='left', on=i)
+        multi_data = decode_display_terms(multi_data, get_display_decoder(display_terms_dict_multi))
 
         # Rename 'index' to 'record_id'
         multi_data.rename(columns={"index": "record_id"}, inplace = True)
@@ -326,6 +598,43 @@ def get_centers(subjects, consented, display_terms):
     centers_df = pd.DataFrame(centers_list, columns = ['treatment_site'])
     return screening_centers_df, centers_df
 
+# ----------------------------------------------------------------------------
+# COMPACT DTYPES
+# ----------------------------------------------------------------------------
+# The cleaned frames keep the 0/1 visit flags as float and the ids as int64. compact_dtypes stores them as
+# nullable int8 and int32, which the table functions use as they are, so the frames are compacted once when
+# they are cleaned and cached and worked on in that form. The site and display columns stay text: the table
+# functions fill, join and group them as text, and their strings are interned as the snapshot is read, so
+# each value is held once whatever the dtype. The rules go by column name and dtype only, never by the
+# values, so a few records cleaned on their own (delta_processing) get the same dtypes as the full snapshot.
+
+flag_cols_prefix = 'start_'
+id_cols = ['record_id', 'main_record_id', 'record_id_start', 'record_id_end', 'mcc', 'instance']
+
+def compact_dtypes(df):
+    '''start_* visit flags as nullable int8 and integer ids as int32'''
+    compact = {}
+    for col in df.columns:
+        dtype = df[col].dtype
+        if col.startswith(flag_cols_prefix) and pd.api.types.is_numeric_dtype(dtype):
+            compact[col] = 'Int8'
+        elif col in id_cols and pd.api.types.is_int64_dtype(dtype) and (df[col].abs() <= np.iinfo('int32').max).all():
+            compact[col] = 'int32'
+    return df.astype(compact)
+
+def get_frames_memory(frames_dict, frame_names = ['subjects', 'consented', 'adverse_events']):
+    '''Memory used by each cleaned frame, in bytes, counting the python strings in object columns (a string
+    shared by many rows is counted on each of them)'''
+    return {frame_name: int(frames_dict[frame_name].memory_usage(deep=True).sum()) for frame_name in frame_names}
+
+@timed_stage
+def compact_frames(frames_dict, frame_names = ['subjects', 'consented', 'adverse_events']):
+    '''Copy of a dictionary of cleaned frames with compact dtypes'''
+    compacted = dict(frames_dict)
+    for frame_name in frame_names:
+        compacted[frame_name] = compact_dtypes(frames_dict[frame_name])
+    return compacted
+
 # ----------------------------------------------------------------------------
 # Get dataframes and parameters
 # ----------------------------------------------------------------------------
@@ -340,28 +649,111 @@ def get_time_parameters(end_report, report_days_range = 7):
     return today, start_report, end_report, report_date_msg, report_range_msg
 
 
+# ----------------------------------------------------------------------------
+# ROLLUPS
+# ----------------------------------------------------------------------------
+# The summary tables count the same records at several levels: tables 1 and 3 by screening site and by MCC
+# (each by surgery type), and tables 4, 7a and 8a by center. Each frame is grouped once, at the finest grain
+# any of those tables needs, into rollup counts of a few hundred rows, and every table level is summed from
+# them (rollup). Adding a level is one more sum over the rollup counts. Rows missing a site or surgery type
+# are left out of the rollup counts, as they are left out of the site level tables.
+
+rollup_grains = {'screened': ['mcc', 'screening_site', 'surgery_type', 'participation_interest_display'],
+                 'consented': ['mcc', 'screening_site', 'surgery_type', 'obtain_date'],
+                 'centers': ['treatment_site', 'surgery_type', 'sp_surg_date']}
+
+def get_screened_counts(subjects):
+    '''Rollup counts of screened subjects by MCC, screening site, surgery type and participation interest'''
+    screened = subjects[rollup_grains['screened'] + ['record_id']].copy()
+
+    #treat mcc column as string
+    screened['mcc'] = screened['mcc'].astype(str)
+
+    # replace missing values with 'no answer'
+    screened['participation_interest_display'] = screened['participation_interest_display'].fillna(value="No Answer")
+
+    return screened.groupby(by=rollup_grains['screened']).count().astype('int64')
+
+def get_consented_counts(consented):
+    '''Rollup counts of consented subjects by MCC, screening site, surgery type and consent date: subjects
+    consented, with a main record id, eligible and rescinded'''
+    eligibility_cols = ['sp_inclcomply', 'sp_inclage1884', 'sp_inclsurg', 'sp_exclnoreadspkenglish', 'sp_mricompatscr',
+                        'sp_exclarthkneerep', 'sp_exclinfdxjoint', 'sp_exclbilkneerep', 'sp_exclothmajorsurg', 'sp_exclprevbilthorpro']
+    t3 = consented[rollup_grains['consented'] + ['main_record_id', 'ewdateterm'] + eligibility_cols].copy()
+    #treat mcc column as string
+    t3['mcc'] = t3['mcc'].astype(str)
+
+    # Get eligible patients using sp field logic
+#    eligible_short is the columns that are used and the same for both surgery types
+# then assess the criteria *by surgery type* 'TKA' = knee, 'Thoracic' = back
+    eligible_short = (t3.sp_inclcomply ==1) & (t3.sp_inclage1884 ==1) & (t3.sp_inclsurg ==1) & (t3.sp_exclnoreadspkenglish ==0) & (t3.sp_mricompatscr ==4)
+    eligible_knee = (t3.surgery_type == 'TKA') & (t3.sp_exclarthkneerep ==0) & (t3.sp_exclinfdxjoint ==0) & (t3.sp_exclbilkneerep ==0)
+    eligible_back = (t3.surgery_type == 'Thoracic') & (t3.sp_exclothmajorsurg ==0) & (t3.sp_exclprevbilthorpro ==0)
+    t3['eligible'] = (eligible_short & eligible_knee) | (eligible_short & eligible_back)
+
+    aggregate_columns_dict={'main_record_id':'count',
+                             'eligible':'sum',
+                             'ewdateterm':'count'}
+    t3_grouped = t3.groupby(by=rollup_grains['consented'])
+    t3_counts = t3_grouped.agg(aggregate_columns_dict)
+    t3_counts['consented'] = t3_grouped.size()
+
+    return t3_counts.astype('int64')
+
+def get_centers_counts(consented):
+    '''Rollup counts of consented subjects by center, surgery type and surgery date: subjects consented,
+    visits started and rescinded. Missing surgery dates are kept as the latest possible date, which is
+    never before the report date.'''
+    visit_cols = ["start_v1_preop", "start_v2_6wk", "start_v3_3mo", "start_6mo", "start_12mo"]
+    table4 = consented[rollup_grains['centers'] + ["main_record_id", 'ewdateterm'] + visit_cols].copy()
+    table4['sp_surg_date'] = pd.to_datetime(table4['sp_surg_date']).fillna(pd.Timestamp.max)
+
+    # Convert Rescinded to boolean
+    table4['ewdateterm'] = table4['ewdateterm'].notnull()
+
+    agg_dict = {'main_record_id':'size',
+                'start_v1_preop':'sum','start_v2_6wk': 'sum',
+                'start_v3_3mo': 'sum', 'start_6mo': 'sum', 'start_12mo': 'sum','ewdateterm': 'sum',}
+
+    return table4.groupby(by=rollup_grains['centers']).agg(agg_dict).astype('int64')
+
+rollup_count_functions = {'screened': lambda subjects, consented: get_screened_counts(subjects),
+                          'consented': lambda subjects, consented: get_consented_counts(consented),
+                          'centers': lambda subjects, consented: get_centers_counts(consented)}
+
+def get_rollup_counts(table_counts, rollup_name, subjects, consented):
+    '''The rollup counts rollup_name from table_counts (get_table_counts), or counted from the frames if
+    table_counts does not have them'''
+    if table_counts is not None and rollup_name in table_counts:
+        return table_counts[rollup_name]
+    return rollup_count_functions[rollup_name](subjects, consented)
+
+def rollup(counts, roll_up_columns):
+    '''Sum rollup counts up to the roll_up_columns levels of their grain'''
+    return counts.groupby(level=roll_up_columns).sum()
+
 # ----------------------------------------------------------------------------
 # Screening Tables
 # ----------------------------------------------------------------------------
-def get_table_1_screening(subjects, consented, roll_up_columns):
-    try:
-        # Get Screening information on ALL subjects
-       # Define needed columns for this table and select subset from main dataframe
-        t1_cols = roll_up_columns + ['participation_interest_display','record_id']
-        t1 = subjects[t1_cols].copy()
+def get_table_1_counts(subjects, consented, roll_up_columns, table_counts = None):
+    '''Counts behind table 1: screened subjects by roll up group and participation interest, and consented
+    subjects by roll up group'''
+    # group by center and participation interest value and count number of IDs in each group
+    t1 = rollup(get_rollup_counts(table_counts, 'screened', subjects, consented), roll_up_columns + ['participation_interest_display'])
 
-        #treat mcc column as string if present
-        if 'mcc' in t1.columns:
-            t1['mcc'] = t1['mcc'].astype(str)
+    # Get counts for *CONSENTED* subjects by site
+    t1_consent = rollup(get_rollup_counts(table_counts, 'consented', subjects, consented), roll_up_columns)
+    t1_consent = t1_consent[['consented']].rename(columns={'consented': 'record_id'})
 
-        # replace missing values with 'no answer'
-        t1[['participation_interest_display']] = t1[['participation_interest_display']].fillna(value="No Answer")
+    return {'screened': t1, 'consented': t1_consent}
 
-        # group by center and participation interest value and count number of IDs in each group
-        t1 = t1.groupby(by=roll_up_columns+['participation_interest_display']).count()
+@timed_stage
+def get_table_1_screening(subjects, consented, roll_up_columns, table_counts = None):
+    try:
+        counts = get_table_1_counts(subjects, consented, roll_up_columns, table_counts)
 
         # Reset data frame index to get dataframe in standard form with center, participation interest flag, count\pagead\aclk
-        t1 = t1.reset_index()
+        t1 = counts['screened'].reset_index()
 
         # Pivot participation interest values into separate columns
         t1 = t1.pivot(index=roll_up_columns, columns='participation_interest_display', values='record_id')
@@ -372,18 +764,8 @@ def get_table_1_screening(subjects, consented, roll_up_columns):
         # Add column of ALL Screened Participants
         t1.loc[:,'All Screened'] = t1.sum(numeric_only=True, axis=1)
 
-        # Get counts for *CONSENTED* subjects by site
-        t1_consent_cols = roll_up_columns + ['record_id']
-        t1_consent = consented[t1_consent_cols]
-
-        # drop missing data rows
-        t1_consent = t1_consent.dropna()
-
-        # group by center and participation interest value and count number of IDs in each group
-        t1_consent = t1_consent.groupby(by=roll_up_columns).count()
-
         # Merge Tables
-        t1 = t1.join(t1_consent)
+        t1 = t1.join(counts['consented'])
 
         # Reset Index so center is a column
         t1 = t1.reset_index()
@@ -406,6 +788,7 @@ def get_table_1_screening(subjects, consented, roll_up_columns):
 
         return None
 
+@timed_stage
 def get_table_2a_screening(df, display_terms_t2a):
     # Get decline columns from dataframe where participant was not interested (participation_interest == 0)
     t2_cols = ['record_id','screening_site','surgery_type','reason_not_interested', 'ptinterest_comment'] # cols to select
@@ -454,6 +837,7 @@ def get_table_2a_screening(df, display_terms_t2a):
 
     return t2_site_count_detailed
 
+@timed_stage
 def get_table_2b_screening(df, start_report, end_report):
     # Each decline includes a comment field - show these for the period of the report (previous 7 days)
     decline_comments = df[df.participation_interest == 0][['screening_site','surgery_type','date_of_contact','ptinterest_comment']].dropna()
@@ -468,31 +852,29 @@ def get_table_2b_screening(df, start_report, end_report):
 
     return decline_comments
 
-def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(), days_range = 30):
-    t3 = df.copy()
-    #treat mcc column as string if present
-    t3['mcc'] = t3['mcc'].astype(str)
+def get_table_3_counts(df, cols_for_groupby, table_counts = None):
+    '''Counts behind table 3 by group and consent date, so the consents in any date range can be
+    counted from them'''
+    t3_counts = rollup(get_rollup_counts(table_counts, 'consented', None, df), cols_for_groupby + ['obtain_date'])
+    return {'consented': t3_counts}
 
-    # Get eligible patients using sp field logic
-#    eligible_short is the columns that are used and the same for both surgery types
-# then assess the criteria *by surgery type* 'TKA' = knee, 'Thoracic' = back
-    eligible_short = (t3.sp_inclcomply ==1) & (t3.sp_inclage1884 ==1) & (t3.sp_inclsurg ==1) & (t3.sp_exclnoreadspkenglish ==0) & (t3.sp_mricompatscr ==4)
-    eligible_knee = (t3.surgery_type == 'TKA') & (t3.sp_exclarthkneerep ==0) & (t3.sp_exclinfdxjoint ==0) & (t3.sp_exclbilkneerep ==0)
-    eligible_back = (t3.surgery_type == 'Thoracic') & (t3.sp_exclothmajorsurg ==0) & (t3.sp_exclprevbilthorpro ==0)
-    t3['eligible'] = (eligible_short & eligible_knee) | (eligible_short & eligible_back)
+@timed_stage
+def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(), days_range = 30, table_counts = None):
+    counts = get_table_3_counts(df, cols_for_groupby, table_counts)
+    t3 = counts['consented'].reset_index()
 
     # Get consent within last days range days
     within_days_range = ((end_report_date - t3.obtain_date).dt.days) <= days_range
-    t3['within_range'] = within_days_range
+    t3['within_range'] = within_days_range * t3['consented']
 
     # Aggregate data for table 3
     # Set the columns to groupby, and the the columns to role up with desired aggregating functions
     # Note: can supply a list of aggregate functions to one columnm i.e. 'col_name': ['min','max']
 #     cols_for_groupby = ["screening_site","surgery_type"]
-    aggregate_columns_dict={'main_record_id':'count',
+    aggregate_columns_dict={'main_record_id':'sum',
                             'obtain_date':'max',
                              'eligible':'sum',
-                             'ewdateterm':'count',
+                             'ewdateterm':'sum',
                            'within_range':'sum'}
     cols = cols_for_groupby + list(aggregate_columns_dict.keys())
     t3_aggregate = t3[cols].groupby(by=cols_for_groupby).agg(aggregate_columns_dict)
@@ -539,27 +921,22 @@ def get_table_3_screening(df,cols_for_groupby, end_report_date = datetime.now(),
 # ----------------------------------------------------------------------------
 # Study Status Tables
 # ----------------------------------------------------------------------------
-def get_table_4(consented_patients, compare_date = datetime.now()):
-    # select table4 columns for patients with a main record id
-    category_cols = ["treatment_site", "surgery_type"]
+def get_table_4_counts(consented_patients, table_counts = None):
+    '''Counts behind table 4 by center, surgery type and surgery date, so completed surgeries can be
+    counted for any date'''
+    return {'consented': get_rollup_counts(table_counts, 'centers', None, consented_patients)}
 
-    table4_cols = ["main_record_id",  "start_v1_preop","sp_surg_date",
-                   "start_v2_6wk","start_v3_3mo","start_6mo","start_12mo", 'ewdateterm']
-
-    table4 = consented_patients[category_cols + table4_cols]
-
-    # Sort by record ID
-    table4 = table4.sort_values(by=['main_record_id'])
+@timed_stage
+def get_table_4(consented_patients, compare_date = datetime.now(), table_counts = None):
+    category_cols = ["treatment_site", "surgery_type"]
+    counts = get_table_4_counts(consented_patients, table_counts)
+    table4 = counts['consented'].reset_index()
 
     # Flag patients with complete surgeries
-    table4['sp_surg_date'] = table4['sp_surg_date'].apply(pd.to_datetime)
-    table4['surg_complete'] = table4['sp_surg_date'] < compare_date
-
-    # Convert Rescinded to boolean
-    table4['ewdateterm'] = table4['ewdateterm'].notnull()
+    table4['surg_complete'] = (table4['sp_surg_date'] < compare_date) * table4['main_record_id']
 
     # Aggregate table 4
-    agg_dict = {'main_record_id':'size',
+    agg_dict = {'main_record_id':'sum',
                 'start_v1_preop':'sum','surg_complete':'sum','start_v2_6wk': 'sum',
                 'start_v3_3mo': 'sum', 'start_6mo': 'sum', 'start_12mo': 'sum','ewdateterm': 'sum',}
     table4_agg = table4.groupby(category_cols).agg(agg_dict).reset_index()
@@ -590,6 +967,7 @@ def get_table_4(consented_patients, compare_date = datetime.now()):
 
     return table4_agg
 
+@timed_stage
 def get_tables_5_6(df):
     # Get patients who rescinded consent, i.e. have a value in the 'ewdateterm' column
     rescinded = df.dropna(subset=['ewdateterm'])
@@ -638,32 +1016,44 @@ def get_deviation_records(consented, adverse_events):
     deviations = deviations.merge(consented[['treatment_site','main_record_id','mcc','start_v1_preop']], how='left', on = ['main_record_id','mcc'])
 
     # convert datetime column to datetime
-    deviations['erep_local_dtime'] = deviations['erep_local_dtime'].apply(pd.to_datetime, errors='coerce')
+    deviations['erep_local_dtime'] = pd.to_datetime(deviations['erep_local_dtime'], errors='coerce')
 
     return deviations
 
 
-def get_deviations_by_center(centers, df, deviations, display_terms_dict):
+def get_deviation_counts(df, deviations):
+    '''Counts behind table 7a: baseline patients with a deviation and deviations by center. Baseline
+    patients by center are summed from the centers rollup counts.'''
     dev_cols = ['main_record_id','treatment_site','start_v1_preop']
     baseline = df[df['start_v1_preop']==1][dev_cols]
-    baseline = baseline.reset_index()
-
-    # Count consented patients who have had baseline visits
-    centers_baseline = baseline[['treatment_site','main_record_id']].groupby(['treatment_site']).size().reset_index(name='baseline')
 
     # Count patients who have an associated deviation
     records_with_deviation = deviations.main_record_id.unique()
     baseline_with_dev = baseline[baseline.main_record_id.isin(records_with_deviation)]
-    centers_baseline_dev = baseline_with_dev[['treatment_site','main_record_id']].groupby(['treatment_site']).size().reset_index(name='patients_with_deviation')
+    centers_baseline_dev = baseline_with_dev[['treatment_site','main_record_id']].groupby(['treatment_site']).size().to_frame('patients_with_deviation')
 
     # Add count of all deviations for a given center
-    center_count = pd.DataFrame(deviations.value_counts(subset=['treatment_site'])).reset_index()
-    center_count.columns =['treatment_site','total_dev']
+    center_count = deviations[['treatment_site']].groupby(['treatment_site']).size().to_frame('total_dev')
+
+    # Count deviations by center and deviation type
+    dev_by_center = deviations[['main_record_id','erep_protdev_type_display', 'instance','treatment_site']]
+    dev_by_center = dev_by_center.groupby(by=['treatment_site','erep_protdev_type_display']).size().to_frame('size')
+
+    return {'baseline_with_deviation': centers_baseline_dev, 'deviations': center_count, 'deviation_types': dev_by_center}
+
+@timed_stage
+def get_deviations_by_center(centers, df, deviations, display_terms_dict, table_counts = None):
+    counts = table_counts.get('table7a') if table_counts is not None else None
+    if counts is None:
+        counts = get_deviation_counts(df, deviations)
+    # Count consented patients who have had baseline visits
+    centers_baseline = rollup(get_rollup_counts(table_counts, 'centers', None, df), ['treatment_site'])['start_v1_preop'].to_frame('baseline').reset_index()
+    centers_baseline_dev = counts['baseline_with_deviation'].reset_index()
+    center_count = counts['deviations'].reset_index()
 
     # Get Deviation Pivot by center
     centers_dev = centers.merge(display_terms_dict['erep_protdev_type'], how='cross')
-    dev_by_center = deviations[['main_record_id','erep_protdev_type_display', 'instance','treatment_site']]
-    dev_by_center = dev_by_center.groupby(by=['treatment_site','erep_protdev_type_display'],as_index=False).size()
+    dev_by_center = counts['deviation_types'].reset_index()
     centers_dev = centers_dev.merge(dev_by_center, how='outer', on=['treatment_site','erep_protdev_type_display']).fillna(0)
     dev_by_center_pivot =  pd.pivot_table(centers_dev, index=["treatment_site"], columns=["erep_protdev_type_display"], values=["size"])
     dev_by_center_pivot.columns = dev_by_center_pivot.columns.droplevel()
@@ -717,6 +1107,7 @@ def get_deviations_by_center(centers, df, deviations, display_terms_dict):
 
     return centers_all
 
+@timed_stage
 def get_table7b_timelimited(deviations,end_report_date = datetime.now(), days_range = 7):
     # Get deviations within last days range days
     within_days_range = ((end_report_date - deviations.erep_local_dtime).dt.days) <= days_range
@@ -757,23 +1148,40 @@ def get_adverse_event_records(consented, adverse_events):
 
     return ae
 
-def get_adverse_events_by_center(centers, df, adverse_events, display_terms_mapping):
+def get_adverse_event_counts(df, adverse_events, ae_api_fields = ['erep_ae_severity' ,'erep_ae_relation']):
+    '''Counts behind table 8a: baseline patients with an adverse event and adverse events by center, and by
+    center and severity / relationship. Baseline patients by center are summed from the centers rollup counts.'''
     # Select subset of patients who have had baseline visits (start_v1_preop not null), using record_id as unique identifier
     baseline_cols = ['main_record_id','treatment_site','start_v1_preop']
     baseline = df[df['start_v1_preop']==1][baseline_cols]
-    baseline = baseline.reset_index()
-
-    # Count consented patients who have had baseline visits
-    centers_baseline = baseline[['treatment_site','main_record_id']].groupby(['treatment_site']).size().reset_index(name='patients_baseline')
 
     # Count patients who have an adverse events
     records_with_adverse_events = adverse_events.main_record_id.unique()
     baseline_with_ae = baseline[baseline.main_record_id.isin(records_with_adverse_events)]
-    centers_baseline_ae = baseline_with_ae[['treatment_site','main_record_id']].groupby(['treatment_site']).size().reset_index(name='patients_with_ae')
+    centers_baseline_ae = baseline_with_ae[['treatment_site','main_record_id']].groupby(['treatment_site']).size().to_frame('patients_with_ae')
 
     # Add count of all adverse events for a given center
-    center_count_ae = pd.DataFrame(adverse_events.value_counts(subset=['treatment_site'])).reset_index()
-    center_count_ae.columns =['treatment_site','total_ae']
+    center_count_ae = adverse_events[['treatment_site']].groupby(['treatment_site']).size().to_frame('total_ae')
+
+    ae_counts = {'baseline_with_ae': centers_baseline_ae, 'adverse_events': center_count_ae}
+
+    # Count adverse events by center and each field
+    for ae_field in ae_api_fields:
+        ae_field_display = ae_field +'_display'
+        ae_by_center = adverse_events[['main_record_id',ae_field_display, 'instance','treatment_site']]
+        ae_counts[ae_field] = ae_by_center.groupby(by=['treatment_site',ae_field_display]).size().to_frame('size')
+
+    return ae_counts
+
+@timed_stage
+def get_adverse_events_by_center(centers, df, adverse_events, display_terms_mapping, table_counts = None):
+    counts = table_counts.get('table8a') if table_counts is not None else None
+    if counts is None:
+        counts = get_adverse_event_counts(df, adverse_events)
+    # Count consented patients who have had baseline visits
+    centers_baseline = rollup(get_rollup_counts(table_counts, 'centers', None, df), ['treatment_site'])['start_v1_preop'].to_frame('patients_baseline').reset_index()
+    centers_baseline_ae = counts['baseline_with_ae'].reset_index()
+    center_count_ae = counts['adverse_events'].reset_index()
 
     # Merge data frames together
     centers_ae = centers
@@ -786,8 +1194,7 @@ def get_adverse_events_by_center(centers, df, adverse_events, display_terms_mapp
     for ae_field in ae_api_fields:
         ae_field_display = ae_field +'_display'
         centers_ae_field = centers.merge(display_terms_mapping[ae_field], how='cross')
-        ae_by_center = adverse_events[['main_record_id',ae_field_display, 'instance','treatment_site']]
-        ae_by_center = ae_by_center.groupby(by=['treatment_site',ae_field_display],as_index=False).size()
+        ae_by_center = counts[ae_field].reset_index()
         centers_ae_field = centers_ae_field.merge(ae_by_center, how='outer', on=['treatment_site',ae_field_display]).fillna(0)
         centers_ae_field = centers_ae_field.drop(ae_field, axis=1)
         ae_by_center_pivot =  pd.pivot_table(centers_ae_field, index=["treatment_site"], columns=[ae_field_display], values=["size"])
@@ -833,6 +1240,7 @@ def get_adverse_events_by_center(centers, df, adverse_events, display_terms_mapp
 
     return centers_ae
 
+@timed_stage
 def get_table_8b(event_records, end_report, report_days = 30):
     table8b_cols_dict = {'treatment_site':'Center',
                          'surgery_type':'Surgery',
@@ -857,7 +1265,7 @@ def get_table_8b(event_records, end_report, report_days = 30):
         table8b = table8b[(table8b.erep_onset_date > start_report) &  (table8b.erep_onset_date <= end_report)]
 
     # convert datetime column to show date
-    table8b.erep_onset_date = table8b.erep_onset_date.apply(pd.to_datetime, errors='coerce').dt.strftime('%m/%d/%Y')
+    table8b.erep_onset_date = pd.to_datetime(table8b.erep_onset_date, errors='coerce').dt.strftime('%m/%d/%Y')
 
     # Use col dict to rename cols for display
     table8b = table8b.rename(columns=table8b_cols_dict)
@@ -865,6 +1273,7 @@ def get_table_8b(event_records, end_report, report_days = 30):
     if len(table8b) <1 :
         return pd.DataFrame(columns = ['No Adverse Events in the reporting timeframe'])
     else:
+        table8b['PID'] = table8b['PID'].astype(int)
         table8b = table8b.sort_values(by=['AE Date'], ascending=False)
 
 
@@ -997,28 +1406,83 @@ def get_enrollment_expectations():
 
     return enrollment_expectations_df
 
-def get_enrollment_expectations_monthly(enrollment_expectations_df):
-    mcc_type_expectations = pd.DataFrame()
-    for i in range(len(enrollment_expectations_df)):
-        mcc = enrollment_expectations_df.iloc[i]['mcc']
-        surgery_type = enrollment_expectations_df.iloc[i]['surgery_type']
-        start_month = enrollment_expectations_df.iloc[i]['start_month']
-        expected_start_count = enrollment_expectations_df.iloc[i]['expected_cumulative_start']
-        expected_monthly = enrollment_expectations_df.iloc[i]['expected_monthly']
-
-        months = pd.period_range(start_month,datetime.now(),freq='M').tolist()
-        expected_monthly_series = [expected_start_count] + (len(months)-1) * [expected_monthly]
-
-        for index, month in enumerate(months):
-            new_row = {'mcc':mcc,
-                       'surgery_type': surgery_type,
-                       'Month': month,
-                       'Expected: Monthly': expected_monthly_series[index],
-                       'Expected: Cumulative': expected_start_count+index*expected_monthly}
-            mcc_type_expectations = mcc_type_expectations.append(new_row, ignore_index=True)
+def get_months_between(start_months, end_month):
+    '''Number of months from each start month up to and including end_month (0 if the start is later)'''
+    months = 12 * (end_month.year - start_months.dt.year) + end_month.month - start_months.dt.month + 1
+    return months.clip(lower=0)
+
+def get_enrollment_expectations_monthly(enrollment_expectations_df, end_month = None):
+    '''Expand the expectations for each mcc and surgery type into one row per month from the start month to end_month'''
+    if end_month is None:
+        end_month = pd.Period(datetime.now(), freq='M')
+
+    # One row per expectation and month, numbered from 0 at the start month
+    row_index = enrollment_expectations_df.index.repeat(get_months_between(enrollment_expectations_df['start_month'], end_month))
+    months = enrollment_expectations_df.loc[row_index].reset_index(drop=True)
+    month_index = months.groupby(row_index.to_numpy()).cumcount()
+
+    mcc_type_expectations = pd.DataFrame({'mcc': months['mcc'],
+                                          'surgery_type': months['surgery_type'],
+                                          'Month': months['start_month'] + month_index.to_numpy(),
+                                          'Expected: Monthly': np.where(month_index == 0, months['expected_cumulative_start'], months['expected_monthly']),
+                                          'Expected: Cumulative': months['expected_cumulative_start'] + month_index * months['expected_monthly']})
 
     return mcc_type_expectations
 
+def get_site_enrollment_expectations(screening_sites):
+    '''Build the expected monthly and cumulative enrollment for every screening site and surgery type from the
+    expected_enrollment and study_month lists in screening_sites.csv. Study month 1 is the site's start_month / start_year.
+    Sites whose two lists differ in length are left out.'''
+    site_cols = ['screening_site', 'mcc', 'surgery_type', 'start_year', 'start_month']
+    sites = screening_sites.dropna(subset=['expected_enrollment', 'study_month', 'start_year', 'start_month']).reset_index(drop=True)
+
+    # Parse the comma separated lists into one row per site and study month
+    expected_lists = sites['expected_enrollment'].astype(str).str.split(',')
+    study_month_lists = sites['study_month'].astype(str).str.split(',')
+    # Unequal lists would shift the study months of every site after this one
+    bad_rows = expected_lists.str.len() != study_month_lists.str.len()
+    for i in sites.index[bad_rows]:
+        print('Skipped screening site {} {}: {} expected_enrollment values for {} study_month values'.format(
+            sites.loc[i, 'screening_site'], sites.loc[i, 'surgery_type'], len(expected_lists[i]), len(study_month_lists[i])))
+    sites, expected_lists, study_month_lists = [series[~bad_rows].reset_index(drop=True) for series in (sites, expected_lists, study_month_lists)]
+    site_expectations = sites.loc[sites.index.repeat(expected_lists.str.len()), site_cols].reset_index(drop=True)
+    site_expectations['study_month'] = pd.to_numeric(pd.Series(np.concatenate(study_month_lists.to_list())).str.strip()).astype(int)
+    site_expectations['Expected: Monthly'] = pd.to_numeric(pd.Series(np.concatenate(expected_lists.to_list())).str.strip()).astype(int)
+
+    # Calendar month of each study month
+    month_number = 12 * site_expectations['start_year'].astype(int) + site_expectations['start_month'].astype(int) - 1 + site_expectations['study_month'] - 1
+    site_expectations['Month'] = pd.to_datetime(pd.DataFrame({'year': month_number // 12, 'month': month_number % 12 + 1, 'day': 1})).dt.to_period('M')
+    site_expectations['Expected: Cumulative'] = site_expectations.groupby(['screening_site', 'surgery_type'])['Expected: Monthly'].cumsum()
+
+    return site_expectations[['screening_site', 'mcc', 'surgery_type', 'study_month', 'Month', 'Expected: Monthly', 'Expected: Cumulative']]
+
+def rollup_site_enrollment_expectations(enrollment_df, site_expectations, end_month = None):
+    '''Actual vs expected enrollment by screening site, surgery type and month. Enrollments before a site's
+    first study month count towards that month.'''
+    if end_month is None:
+        end_month = pd.Period(datetime.now(), freq='M')
+    group_cols = ['screening_site', 'surgery_type']
+    site_rollup = site_expectations[site_expectations['Month'] <= end_month]
+
+    first_month = site_rollup.groupby(group_cols)['Month'].min().rename('first_month').reset_index()
+    enrollment_df = enrollment_df.merge(first_month, how='inner', on=group_cols)
+    enrollment_df['Month'] = enrollment_df['obtain_month'].where(enrollment_df['obtain_month'] > enrollment_df['first_month'], enrollment_df['first_month'])
+    actual = enrollment_df.groupby(group_cols + ['Month']).size().reset_index(name='Actual: Monthly')
+
+    site_rollup = site_rollup.merge(actual, how='left', on=group_cols + ['Month'])
+    site_rollup['Actual: Monthly'] = site_rollup['Actual: Monthly'].fillna(0).astype(int)
+    site_rollup['Actual: Cumulative'] = site_rollup.groupby(group_cols)['Actual: Monthly'].cumsum()
+
+    site_rollup['Percent: Monthly'] = (100 * site_rollup['Actual: Monthly'] / site_rollup['Expected: Monthly']).round(1).astype(str) + '%'
+    site_rollup['Percent: Cumulative'] = (100 * site_rollup['Actual: Cumulative'] / site_rollup['Expected: Cumulative']).round(1).astype(str) + '%'
+    site_rollup.loc[site_rollup['Actual: Monthly'] == 0, 'Percent: Monthly'] = ''
+
+    site_rollup['Site'] = site_rollup['screening_site'] + ' (' + site_rollup['surgery_type'] + ')'
+    site_rollup_cols = ['Site', 'Month', 'study_month', 'Actual: Monthly', 'Actual: Cumulative',
+       'Expected: Monthly', 'Expected: Cumulative', 'Percent: Monthly','Percent: Cumulative']
+
+    return site_rollup[site_rollup_cols].reset_index(drop=True)
+
 def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations):
     enrollment_df = enrollment_df.merge(enrollment_expectations_df[['mcc','surgery_type','start_month']], how='left', on=['mcc','surgery_type'])
 
@@ -1043,7 +1507,7 @@ def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, mo
     ee_rollup.loc[ee_rollup['Actual: Monthly'] == 0, 'Percent: Monthly'] = ''
 
     # Add Site name column
-    ee_rollup['Site'] = ee_rollup.apply(lambda x: 'MCC' + str(x['mcc']) + ' (' + x['surgery_type'] + ')',axis=1)
+    ee_rollup['Site'] = 'MCC' + ee_rollup['mcc'].astype(str) + ' (' + ee_rollup['surgery_type'] + ')'
     ee_rollup_cols = ['Site','Month', 'Actual: Monthly', 'Actual: Cumulative',
        'Expected: Monthly', 'Expected: Cumulative', 'Percent: Monthly','Percent: Cumulative']
 
@@ -1058,42 +1522,77 @@ def rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, mo
 # ----------------------------------------------------------------------------
 # GET DATA FOR PAGE
 # ----------------------------------------------------------------------------
-def get_tables(today, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df):
-    ''' Load all the data for the page'''
-    ## SCREENING TABLES
-
-    table1a = get_table_1_screening(subjects, consented, ['screening_site','surgery_type'])
-    table1b = get_table_1_screening(subjects, consented, ['mcc','surgery_type'])
+@timed_stage
+def get_table_counts(subjects, consented, adverse_events, table_names = None):
+    '''Counts behind the summary tables (1, 3, 4, 7a and 8a): the rollup counts (rollup_grains) the site, MCC
+    and center levels are summed from, and the per patient counts of tables 7a and 8a. The counts do not
+    depend on the report date and add up across records, so they can be saved with the cleaned data and
+    updated record by record.'''
+    table_counts = {}
+    if table_names is None:
+        table_names = list(rollup_grains) + ['table7a', 'table8a']
+    for rollup_name in rollup_grains:
+        if rollup_name in table_names:
+            table_counts[rollup_name] = rollup_count_functions[rollup_name](subjects, consented)
+    if 'table7a' in table_names:
+        table_counts['table7a'] = get_deviation_counts(consented, get_deviation_records(consented, adverse_events))
+    if 'table8a' in table_names:
+        table_counts['table8a'] = get_adverse_event_counts(consented, get_adverse_event_records(consented, adverse_events))
+    return table_counts
+
+def get_screening_tables(subjects, consented, display_terms_dict_multi, today, start_report, end_report, table_counts = None):
+    '''Tables for the Screening section'''
+    if table_counts is None:
+        table_counts = {}
+
+    table1a = get_table_1_screening(subjects, consented, ['screening_site','surgery_type'], table_counts)
+    table1b = get_table_1_screening(subjects, consented, ['mcc','surgery_type'], table_counts)
 
     display_terms_t2a = display_terms_dict_multi['reason_not_interested']
     table2a = get_table_2a_screening(subjects, display_terms_t2a)
 
     table2b = get_table_2b_screening(subjects, start_report, end_report)
 
-    table3a = get_table_3_screening(consented, ["screening_site","surgery_type"], today, 30)
-    table3b = get_table_3_screening(consented, ["mcc","surgery_type"], today, 30)
+    table3a = get_table_3_screening(consented, ["screening_site","surgery_type"], today, 30, table_counts)
+    table3b = get_table_3_screening(consented, ["mcc","surgery_type"], today, 30, table_counts)
 
-    ## STUDY Status
-    table4 = get_table_4(consented, today)
+    return {'table1a': table1a, 'table1b': table1b, 'table2a': table2a, 'table2b': table2b, 'table3a': table3a, 'table3b': table3b}
+
+def get_study_status_tables(consented, today, table_counts = None):
+    '''Tables for the Study Status section'''
+    if table_counts is None:
+        table_counts = {}
+
+    table4 = get_table_4(consented, today, table_counts)
 
     table5, table6 = get_tables_5_6(consented)
 
-    ## Deviations & Adverse Events
+    return {'table4': table4, 'table5': table5, 'table6': table6}
+
+def get_deviation_and_adverse_event_tables(consented, adverse_events, centers_df, display_terms_dict_multi, today, table_counts = None):
+    '''Tables for the Deviations & Adverse Events section'''
+    if table_counts is None:
+        table_counts = {}
+
     ### Deviations
     deviations = get_deviation_records(consented, adverse_events)
-    table7a = get_deviations_by_center(centers_df, consented, deviations, display_terms_dict_multi)
-    table7b = get_table7b_timelimited(deviations)
+    table7a = get_deviations_by_center(centers_df, consented, deviations, display_terms_dict_multi, table_counts)
+    table7b = get_table7b_timelimited(deviations, today)
 
     ### Adverse Events
     ae = get_adverse_event_records(consented, adverse_events)
-    table8a = get_adverse_events_by_center(centers_df, consented, ae, display_terms_dict_multi)
+    table8a = get_adverse_events_by_center(centers_df, consented, ae, display_terms_dict_multi, table_counts)
     table8b = get_table_8b(ae, today, None)
 
-    ## Demographics
+    return {'table7a': table7a, 'table7b': table7b, 'table8a': table8a, 'table8b': table8b}
+
+@timed_stage
+def get_demographics_tables(consented, display_terms_dict):
+    '''Tables for the Demographics section'''
     demographics = get_demographic_data(consented)
     # get subset of active patients
     demo_active = demographics[demographics['Status']=='Active'].copy()
-    demo_active['category'] = demo_active.apply(lambda x: 'MCC ' + str(x['MCC'])  + ' / ' +x['Surgery'], axis=1)
+    demo_active['category'] = 'MCC ' + demo_active['MCC'].astype(str) + ' / ' + demo_active['Surgery']
 
     # Currently splitting on MCC values
     split_col = 'category'
@@ -1116,10 +1615,21 @@ def get_tables(today, start_report, end_report, report_date_msg, report_range_ms
     age_df["Age"] = pd.to_numeric(age_df["Age"], errors='coerce') # handle records that have no age value anywhere
     age = get_describe_col_subset(age_df, 'Age', 'category')
 
+    return {'sex': sex, 'race': race, 'ethnicity': ethnicity, 'age': age}
+
+def get_tables(today, start_report, end_report, report_date_msg, report_range_msg, display_terms, display_terms_dict, display_terms_dict_multi, subjects, consented, adverse_events, centers_df, table_counts = None):
+    ''' Load all the data for the page. table_counts (from get_table_counts) are used for the summary tables if given.'''
+    tables = get_screening_tables(subjects, consented, display_terms_dict_multi, today, start_report, end_report, table_counts)
+    tables.update(get_study_status_tables(consented, today, table_counts))
+    tables.update(get_deviation_and_adverse_event_tables(consented, adverse_events, centers_df, display_terms_dict_multi, today, table_counts))
+    tables.update(get_demographics_tables(consented, display_terms_dict))
 
-    return table1a, table1b, table2a, table2b, table3a, table3b, table4, table5, table6, table7a, table7b, table8a, table8b, sex, race, ethnicity, age
+    tables_names = ("table1a", "table1b", "table2a", "table2b", "table3a", "table3b","table4", "table5", "table6", "table7a", "table7b", "table8a", "table8b", "sex", "race", "ethnicity", "age")
+    return tuple(tables[table_name] for table_name in tables_names)
 
-def get_enrollment_tables(consented):
+def get_enrollment_tables(consented, screening_sites = None):
+    '''Enrollment tables. The site expectations come from screening_sites if given, else from this process's
+    screening sites asset.'''
     enrollment_df = get_enrollment_data(consented)
 
     enrollment_df, index_col, grouping_cols, count_col_name = enrollment_df, 'obtain_month', ['mcc','screening_site','surgery_type','Site'], 'Monthly'
@@ -1132,7 +1642,10 @@ def get_enrollment_tables(consented):
     monthly_expectations = get_enrollment_expectations_monthly(enrollment_expectations_df)
     summary_rollup = rollup_enrollment_expectations(enrollment_df, enrollment_expectations_df, monthly_expectations)
 
-    return mcc1_enrollments, mcc2_enrollments, summary_rollup
+    site_expectations = get_site_enrollment_expectations(screening_sites) if screening_sites is not None else get_screening_site_expectations()
+    site_rollup = rollup_site_enrollment_expectations(enrollment_df, site_expectations)
+
+    return mcc1_enrollments, mcc2_enrollments, summary_rollup, site_rollup
 
 
 # ----------------------------------------------------------------------------
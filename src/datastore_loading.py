@@ -2,11 +2,49 @@ import os
 import requests
 import json
 import traceback
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------------------------------
 #   MOVE THIS TO REFERENCE FROM ENV
 # ---------------------------------
 DATASTORE_URL =  os.getenv('DATASTORE_URL')
+FETCH_TIMEOUT = float(os.getenv('FETCH_TIMEOUT', 10)) # seconds to wait on the datastore before using the local snapshot
+FETCH_CONNECT_TIMEOUT = float(os.getenv('FETCH_CONNECT_TIMEOUT', 3.05))
+FETCH_RETRIES = int(os.getenv('FETCH_RETRIES', 2))
+FETCH_BACKOFF = float(os.getenv('FETCH_BACKOFF', 0.5)) # retries wait FETCH_BACKOFF * 2^(retry - 1) seconds
+FETCH_BUDGET = float(os.getenv('FETCH_BUDGET', 20)) # overall seconds allowed for fetching all files
+
+# ---------------------------------
+#   Shared HTTP client
+# ---------------------------------
+http_session = None
+http_session_pid = None
+
+def get_http_session():
+    '''Return the HTTP session for this process. The session keeps connections to the datastore alive
+    between requests, and retries failed requests with a bounded backoff. A new session is created
+    after a fork so gunicorn workers never share a connection pool.'''
+    global http_session, http_session_pid
+    if http_session is None or http_session_pid != os.getpid():
+        retry = Retry(total=FETCH_RETRIES,
+                      backoff_factor=FETCH_BACKOFF,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['GET'],
+                      respect_retry_after_header=False,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        http_session, http_session_pid = session, os.getpid()
+    return http_session
+
+def http_get(url, headers = None, timeout = FETCH_TIMEOUT):
+    return get_http_session().get(url, headers=headers, timeout=(FETCH_CONNECT_TIMEOUT, timeout))
 
 # ---------------------------------
 #   Get Data From datastore
@@ -16,8 +54,8 @@ def get_api_data(api_address):
     api_json = {}
     try:
         try:
-            response = requests.get(api_address)
-        except:
+            response = http_get(api_address)
+        except Exception as e:
             return('error: {}'.format(e))
         request_status = response.status_code
         if request_status == 200:
@@ -29,3 +67,122 @@ def get_api_data(api_address):
         traceback.print_exc()
         api_json['json'] = 'error: {}'.format(e)
         return api_json
+
+# ---------------------------------
+#   Local snapshots of datastore files
+# ---------------------------------
+
+def get_snapshot_meta_file(snapshot_file):
+    return str(snapshot_file) + '.meta.json'
+
+def load_snapshot_meta(snapshot_file):
+    '''Load the ETag / Last-Modified headers saved with a local snapshot'''
+    try:
+        with open(get_snapshot_meta_file(snapshot_file), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write_file_atomic(file_path, content, mode = 'wb'):
+    '''Write to a temporary file in the target directory, then move it into place so readers
+    (including other gunicorn workers) never see a partially written file'''
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(str(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(content)
+        os.replace(tmp_file, file_path)
+    except Exception:
+        os.remove(tmp_file)
+        raise
+
+def save_snapshot(snapshot_file, content, response):
+    '''Save a good response as the last-known-good snapshot along with its cache validators'''
+    write_file_atomic(snapshot_file, content)
+    meta = {'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': datetime.now().isoformat()}
+    write_file_atomic(get_snapshot_meta_file(snapshot_file), json.dumps(meta), 'w')
+
+def load_snapshot(snapshot_file, parse = True):
+    '''Return the parsed json from a snapshot, or just the path to the snapshot file if parse is False'''
+    if not parse:
+        return snapshot_file
+    with open(snapshot_file, 'r') as f:
+        return json.load(f)
+
+def check_json_object(content):
+    '''Cheap check that a downloaded document is a complete json object, for use when the
+    response is not parsed on download'''
+    content = content.strip()
+    if not (content[:1] == b'{' and content[-1:] == b'}'):
+        raise ValueError('response is not a complete json object')
+
+def fetch_json_snapshot(url, snapshot_file, timeout = FETCH_TIMEOUT, parse = True):
+    '''Get a json file from the datastore, keeping a local last-known-good copy in snapshot_file.
+    A conditional request is sent using the validators saved with the snapshot, so an unchanged
+    file is not downloaded again. If the datastore fails or does not answer within timeout
+    seconds, the snapshot is used instead.
+
+    Returns the json data (or the snapshot file path if parse is False, or None if there is neither
+    a response nor a snapshot) and a status of 'downloaded', 'not_modified', 'snapshot' (datastore
+    failed, snapshot used) or 'unavailable'.'''
+    have_snapshot = os.path.exists(snapshot_file)
+    headers = {}
+    if have_snapshot:
+        meta = load_snapshot_meta(snapshot_file)
+        if meta.get('url') == url:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        r = http_get(url, headers=headers, timeout=timeout)
+        if r.status_code == 304 and have_snapshot:
+            return load_snapshot(snapshot_file, parse), 'not_modified'
+        if r.status_code == 200:
+            # only keep responses that parse
+            if parse:
+                json_data = json.loads(r.content)
+            else:
+                check_json_object(r.content)
+                json_data = snapshot_file
+            save_snapshot(snapshot_file, r.content, r)
+            return json_data, 'downloaded'
+        print('{} returned status {}'.format(url, r.status_code))
+    except Exception as e:
+        print('{} request failed: {}'.format(url, e))
+
+    if have_snapshot:
+        print('Using local snapshot {}'.format(snapshot_file))
+        return load_snapshot(snapshot_file, parse), 'snapshot'
+    return None, 'unavailable'
+
+def fetch_json_snapshots(snapshot_sources, timeout = FETCH_TIMEOUT, budget = FETCH_BUDGET, parse = True):
+    '''Fetch several json files in parallel with fetch_json_snapshot. snapshot_sources is a dictionary of
+    key: (url, snapshot_file). Total time is bounded by budget seconds: any download still running when
+    the budget runs out is left to finish in the background and its local snapshot is used instead.
+
+    Returns dictionaries of key: json data (or snapshot file path if parse is False) and key: status.'''
+    json_data, status = {}, {}
+    if not snapshot_sources:
+        return json_data, status
+
+    executor = ThreadPoolExecutor(max_workers=len(snapshot_sources))
+    futures = {key: executor.submit(fetch_json_snapshot, url, snapshot_file, timeout, parse)
+               for key, (url, snapshot_file) in snapshot_sources.items()}
+    wait(futures.values(), timeout=budget)
+    executor.shutdown(wait=False)
+
+    for key, future in futures.items():
+        url, snapshot_file = snapshot_sources[key]
+        if future.done() and future.exception() is None:
+            json_data[key], status[key] = future.result()
+        elif os.path.exists(snapshot_file):
+            print('{} not fetched within {}s, using local snapshot'.format(url, budget))
+            json_data[key], status[key] = load_snapshot(snapshot_file, parse), 'snapshot'
+        else:
+            json_data[key], status[key] = None, 'unavailable'
+
+    return json_data, status
@@ -0,0 +1,168 @@
+# Libraries
+import traceback
+# Data
+import numpy as np
+import pandas as pd # Dataframe manipulations
+
+# import local modules
+from config_settings import *
+from data_processing import *
+
+# ----------------------------------------------------------------------------
+# RECORD CHANGES
+# ----------------------------------------------------------------------------
+# A new subjects snapshot usually differs from the last one in a handful of records. The json text of
+# each record is hashed as the snapshot is read (load_subjects_files), and comparing those hashes with
+# the ones saved with the last cleaned snapshot gives the records that were added, changed or deleted.
+# Records are identified by (mcc, record id), with the record id as the json key text.
+
+def get_record_keys(df, id_col = 'record_id'):
+    '''(mcc, record id) key for each row of a raw or cleaned dataframe'''
+    return pd.MultiIndex.from_arrays([df['mcc'].astype('int64').to_numpy(), df[id_col].astype(str).to_numpy()], names=['mcc', 'record_id'])
+
+def get_changed_records(old_hashes, new_hashes):
+    '''Keys of the records that were added, changed or deleted between two snapshots'''
+    record_hashes = old_hashes.merge(new_hashes, how='outer', on=['mcc', 'record_id'], suffixes=('_old', '_new'))
+    changed = record_hashes[record_hashes['record_hash_old'] != record_hashes['record_hash_new']]
+    return get_record_keys(changed)
+
+def patch_records(saved_df, saved_keys, changed_mask, delta_df, record_order):
+    '''Replace the rows of the changed records in saved_df with the rows cleaned from the new snapshot
+    (delta_df) and put the rows in snapshot order (record_order is a series of positions indexed by
+    record key), keeping the order of rows within a record. Returns the patched dataframe and a mask
+    of the rows of the changed records in it.'''
+    keys = saved_keys[~changed_mask].append(get_record_keys(delta_df))
+    patched_mask = np.concatenate([np.zeros((~changed_mask).sum(), dtype=bool), np.ones(len(delta_df), dtype=bool)])
+    order = np.argsort(record_order.reindex(keys).to_numpy(), kind='stable')
+    patched_df = pd.concat([saved_df[~changed_mask], delta_df], ignore_index=True).iloc[order].reset_index(drop=True)
+    return patched_df, patched_mask[order]
+
+# ----------------------------------------------------------------------------
+# PATCH CLEANED FRAMES
+# ----------------------------------------------------------------------------
+
+def match_dtypes(delta_df, saved_df):
+    '''Give a dataframe cleaned from a few records the columns and dtypes of the saved dataframe it is patched
+    into. A few records can clean to the columns in another order, or without a column the full snapshot
+    has (dem_race_original is only made if some record has a race): the columns are put in the saved
+    order and missing ones are added as nan. A column cleaned from a few records can come out as float
+    (all nan) or int where the full snapshot gives object, float or a nullable dtype. Returns None, saying why, if the
+    records clean to columns the saved dataframe does not have or to any other dtype.'''
+    extra_cols = delta_df.columns.difference(saved_df.columns)
+    if len(extra_cols) > 0:
+        print('Columns {} cleaned but not saved'.format(', '.join(map(str, extra_cols))))
+        return None
+    delta_df = delta_df.reindex(columns=saved_df.columns)
+    for col in delta_df.columns:
+        dtype = saved_df[col].dtype
+        if delta_df[col].dtype == dtype:
+            continue
+        all_nan = delta_df[col].isna().all() and (dtype == object or pd.api.types.is_float_dtype(dtype) or pd.api.types.is_datetime64_dtype(dtype) or pd.api.types.is_extension_array_dtype(dtype))
+        int_to_float = pd.api.types.is_float_dtype(dtype) and (pd.api.types.is_integer_dtype(delta_df[col].dtype) or pd.api.types.is_bool_dtype(delta_df[col].dtype))
+        if not (all_nan or int_to_float):
+            print('Column {} cleaned as {} but saved as {}'.format(col, delta_df[col].dtype, dtype))
+            return None
+        delta_df[col] = delta_df[col].astype(dtype)
+    return delta_df
+
+@timed_stage
+def patch_clean_frames(saved_frames, subjects_raw, adverse_effects, record_hashes, screening_sites, display_terms_dict, display_terms_dict_multi, max_fraction = REPORT_DELTA_MAX_FRACTION):
+    '''Update the cleaned frames (and table counts) of the last snapshot to a new snapshot by cleaning only the
+    records that changed. Returns None if the frames need to be cleaned in full instead: too many records
+    changed, or the changed records clean to different columns or dtypes.'''
+    try:
+        changed_records = get_changed_records(saved_frames['record_hashes'], record_hashes)
+        print('{} of {} records changed since the last snapshot'.format(len(changed_records), len(record_hashes)))
+        if len(changed_records) > max_fraction * len(record_hashes):
+            return None
+
+        subjects, consented, adverse_events = saved_frames['subjects'], saved_frames['consented'], saved_frames['adverse_events']
+
+        # Clean the new and changed records on their own
+        raw_keys = get_record_keys(subjects_raw, 'index')
+        delta_raw = subjects_raw[raw_keys.isin(changed_records)].reset_index(drop=True)
+        delta_adverse_effects = adverse_effects[get_record_keys(adverse_effects, 'index').isin(changed_records)].reset_index(drop=True)
+        if len(delta_raw) > 0:
+            # Columns that are text in the full snapshot stay text in the changed records too
+            text_cols = {'subjects': list(subjects.columns[subjects.dtypes == object]), 'adverse_events': list(adverse_events.columns[adverse_events.dtypes == object])}
+            delta_subjects, delta_consented, delta_adverse_events = clean_subjects(delta_raw, delta_adverse_effects, screening_sites, display_terms_dict, display_terms_dict_multi, text_cols=text_cols)
+            delta_subjects = match_dtypes(compact_dtypes(delta_subjects), subjects)
+            delta_adverse_events = match_dtypes(compact_dtypes(delta_adverse_events), adverse_events)
+            if delta_subjects is None or delta_adverse_events is None:
+                return None
+        else:
+            delta_subjects, delta_adverse_events = subjects.iloc[:0], adverse_events.iloc[:0]
+
+        # Replace the old versions of the changed records and put all rows back in snapshot order
+        subjects_keys, adverse_events_keys = get_record_keys(subjects), get_record_keys(adverse_events)
+        saved_masks = {'subjects': subjects_keys.isin(changed_records), 'adverse_events': adverse_events_keys.isin(changed_records)}
+        record_order = pd.Series(np.arange(len(raw_keys)), index=raw_keys)
+        new_subjects, new_subjects_mask = patch_records(subjects, subjects_keys, saved_masks['subjects'], delta_subjects, record_order)
+        new_adverse_events, new_adverse_events_mask = patch_records(adverse_events, adverse_events_keys, saved_masks['adverse_events'], delta_adverse_events, record_order)
+        new_consented = get_consented_subjects(new_subjects)
+        # Adverse events take the treatment site of the (possibly changed) consented record
+        new_adverse_events = new_consented[['record_id','treatment_site']].copy().merge(new_adverse_events.drop(columns='treatment_site'), how='right', on='record_id')
+        new_masks = {'subjects': new_subjects_mask, 'adverse_events': new_adverse_events_mask}
+
+        new_frames = {'subjects': new_subjects, 'consented': new_consented, 'adverse_events': new_adverse_events, 'record_hashes': record_hashes}
+        table_counts = patch_table_counts(saved_frames['table_counts'], saved_frames, saved_masks, new_frames, new_masks)
+        if table_counts is None:
+            return None
+        new_frames['table_counts'] = table_counts
+
+        return new_frames
+
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+# ----------------------------------------------------------------------------
+# PATCH TABLE COUNTS
+# ----------------------------------------------------------------------------
+# The rollup counts behind tables 1, 3 and 4 (and the baseline patients of 7a and 8a) add up record by
+# record, so the changed records' old counts are subtracted and their new counts added. Tables 7a and 8a
+# count baseline patients that have a deviation or adverse event, which depends on every record sharing a
+# main record id, so for those the old and new counts of all records sharing a main record id with a
+# changed record are swapped instead.
+
+record_count_tables = list(rollup_grains)
+main_record_count_tables = ['table7a', 'table8a']
+
+def get_changed_table_counts(frames, changed_masks, main_record_ids):
+    '''Counts for the part of the snapshot touched by the changed records'''
+    subjects, consented, adverse_events = frames['subjects'], frames['consented'], frames['adverse_events']
+    # consented keeps the index of the subjects rows it was selected from
+    consented_mask = changed_masks['subjects'][subjects.index.get_indexer(consented.index)]
+    table_counts = get_table_counts(subjects[changed_masks['subjects']], consented[consented_mask], adverse_events[changed_masks['adverse_events']], record_count_tables)
+    table_counts.update(get_table_counts(subjects[subjects.main_record_id.isin(main_record_ids)], consented[consented.main_record_id.isin(main_record_ids)], adverse_events[adverse_events.main_record_id.isin(main_record_ids)], main_record_count_tables))
+    return table_counts
+
+def patch_counts(counts, old_counts, new_counts):
+    '''Add the change from old_counts to new_counts to a (nested dictionary of) count dataframe(s). Groups
+    that drop to zero are removed, as they would not appear in counts of the full snapshot.'''
+    if isinstance(counts, dict):
+        patched = {}
+        for name in counts:
+            patched[name] = patch_counts(counts[name], old_counts[name], new_counts[name])
+            if patched[name] is None:
+                return None
+        return patched
+
+    counts_change = new_counts.sub(old_counts, fill_value=0)
+    counts_change = counts_change[(counts_change != 0).any(axis=1)]
+    if len(counts_change) == 0:
+        return counts
+    counts = counts.add(counts_change, fill_value=0)
+    if (counts < 0).any(axis=None):
+        print('Patched counts are negative')
+        return None
+    return counts[(counts != 0).any(axis=1)].astype('int64').sort_index()
+
+def patch_table_counts(table_counts, old_frames, old_masks, new_frames, new_masks):
+    main_record_ids = pd.concat([old_frames['subjects'].loc[old_masks['subjects'], 'main_record_id'],
+                                 old_frames['adverse_events'].loc[old_masks['adverse_events'], 'main_record_id'],
+                                 new_frames['subjects'].loc[new_masks['subjects'], 'main_record_id'],
+                                 new_frames['adverse_events'].loc[new_masks['adverse_events'], 'main_record_id']]).unique()
+    old_counts = get_changed_table_counts(old_frames, old_masks, main_record_ids)
+    new_counts = get_changed_table_counts(new_frames, new_masks, main_record_ids)
+    return patch_counts(table_counts, old_counts, new_counts)
@@ -0,0 +1,157 @@
+# Libraries
+import traceback
+import operator
+import math
+import re
+# Data
+import numpy as np
+import pandas as pd # Dataframe manipulations
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# LISTING TABLES
+# ----------------------------------------------------------------------------
+# The listing tables (decline comments, rescinded consent, early termination, deviation and adverse event
+# descriptions) have a row per record, with free text, and grow over the course of the study. The page
+# shows them one page at a time: paging, sorting and filtering run on the server (the datatables use
+# page_action, sort_action and filter_action 'custom') against a listing built once per report section.
+# The listing keeps the table's rows, a sort key for each column (the rank of each value, -1 if missing)
+# and each column's values as lower case text for filtering.
+
+# Table name: report section the table is built in
+listing_tables = {'table2b': 'section1', 'table5': 'section2', 'table6': 'section2', 'table7b': 'section3', 'table8b': 'section3'}
+
+def get_sort_values(values):
+    '''Values of a listing column as they sort: text without case, and dates shown as mm/dd/yyyy text as dates'''
+    if values.dtype != object:
+        return values
+    present = values.dropna()
+    if len(present) == 0 or not present.map(lambda value: isinstance(value, str)).all():
+        return values
+    dates = pd.to_datetime(values, format='%m/%d/%Y', errors='coerce')
+    if dates.notna().sum() == len(present):
+        return dates
+    return values.str.lower()
+
+def get_sort_key(sort_values):
+    '''Rank of each value of a column (equal values share a rank), -1 for missing values'''
+    try:
+        codes, uniques = pd.factorize(sort_values, sort=True)
+    except TypeError:
+        # Values of mixed types sort as text
+        codes, uniques = pd.factorize(sort_values.where(sort_values.isna(), sort_values.astype(str)), sort=True)
+    return codes
+
+def build_listing(table_dict):
+    '''Listing of a table (from get_tables_dict) for paging, sorting and filtering on the server'''
+    columns = [column['id'] for column in table_dict['columns_list']]
+    df = pd.DataFrame(table_dict['data'], columns=columns)
+    listing = {'records': table_dict['data'], 'values': {}, 'sort_keys': {}, 'text': {}}
+    for col in columns:
+        sort_values = get_sort_values(df[col])
+        listing['values'][col] = sort_values
+        listing['sort_keys'][col] = get_sort_key(sort_values)
+        listing['text'][col] = df[col].astype(str).str.lower().where(df[col].notna(), '')
+    return listing
+
+# ----------------------------------------------------------------------------
+# FILTER QUERIES
+# ----------------------------------------------------------------------------
+# The datatable filter row writes queries such as {Reason} contains "pain" && {PID} > 1000. Each part is
+# read as its column in braces, then the operator (a word, or a symbol for the comparisons) as the next token,
+# then the rest as the value, so a value may itself hold operator words ("schedule change", "done ").
+
+filter_comparisons = {'ge': operator.ge, 'le': operator.le, 'lt': operator.lt, 'gt': operator.gt, 'ne': operator.ne, 'eq': operator.eq}
+filter_symbols = {'>=': 'ge', '<=': 'le', '<': 'lt', '>': 'gt', '!=': 'ne', '=': 'eq'}
+filter_text_operators = ['contains', 'datestartswith']
+filter_operators = list(filter_comparisons) + filter_text_operators
+filter_part_pattern = re.compile(r'\s*\{(?P<name>[^}]*)\}\s*(?P<operator>>=|<=|!=|<|>|=|[a-z]+(?=\s|$))(?P<value>.*)', re.DOTALL)
+
+def split_filter_part(filter_part):
+    '''(column, operator, value) of one part of a filter query, or (None, None, None). The value of a
+    comparison is a float if it is an unquoted number; for contains and datestartswith it is the text as typed.'''
+    match = filter_part_pattern.match(filter_part)
+    if match is None:
+        return None, None, None
+    name, filter_operator, value_part = match.group('name'), match.group('operator'), match.group('value').strip()
+    filter_operator = filter_symbols.get(filter_operator, filter_operator)
+    # The datatable's case sensitive (s) and insensitive (i) forms filter alike here, as the text is lower case
+    if filter_operator not in filter_operators and filter_operator[:1] in ('i', 's') and filter_operator[1:] in filter_operators:
+        filter_operator = filter_operator[1:]
+    if filter_operator not in filter_operators or not value_part:
+        return None, None, None
+    quote = value_part[0]
+    if quote == value_part[-1] and quote in ("'", '"', '`') and len(value_part) > 1:
+        value = value_part[1: -1].replace('\\' + quote, quote)
+    elif filter_operator in filter_text_operators:
+        value = value_part
+    else:
+        try:
+            value = float(value_part)
+        except ValueError:
+            value = value_part
+    return name, filter_operator, value
+
+def get_comparison_mask(values, text, filter_operator, value):
+    '''Rows of a column that compare to value with filter_operator: as dates, numbers or lower case text,
+    as the column is'''
+    compare = filter_comparisons[filter_operator]
+    if pd.api.types.is_datetime64_any_dtype(values):
+        value = pd.to_datetime(str(value), errors='coerce')
+        return compare(values, value).to_numpy() if not pd.isna(value) else np.zeros(len(values), dtype=bool)
+    if pd.api.types.is_numeric_dtype(values):
+        if not isinstance(value, float):
+            return np.zeros(len(values), dtype=bool)
+        return compare(values, value).to_numpy()
+    value = str(int(value) if isinstance(value, float) and value.is_integer() else value).lower()
+    return compare(text, value).to_numpy() & values.notna().to_numpy()
+
+def get_filter_mask(listing, filter_query):
+    '''Rows of a listing that match a datatable filter query. Parts that cannot be read are ignored.'''
+    mask = np.ones(len(listing['records']), dtype=bool)
+    if not filter_query:
+        return mask
+    for filter_part in filter_query.split(' && '):
+        col, filter_operator, value = split_filter_part(filter_part)
+        if col not in listing['text']:
+            continue
+        text = listing['text'][col]
+        if filter_operator == 'contains':
+            mask &= text.str.contains(value.lower(), regex=False).to_numpy()
+        elif filter_operator == 'datestartswith':
+            mask &= text.str.startswith(value.lower()).to_numpy()
+        else:
+            mask &= get_comparison_mask(listing['values'][col], text, filter_operator, value)
+    return mask
+
+# ----------------------------------------------------------------------------
+# PAGES
+# ----------------------------------------------------------------------------
+
+def get_sort_order(listing, sort_by, rows):
+    '''Order of rows sorted by the datatable sort_by columns, with missing values last'''
+    sort_keys = []
+    for sort_column in sort_by:
+        if sort_column['column_id'] not in listing['sort_keys']:
+            continue
+        sort_key = listing['sort_keys'][sort_column['column_id']][rows]
+        sort_keys.append((sort_key < 0, -sort_key if sort_column['direction'] == 'desc' else sort_key))
+    if not sort_keys:
+        return np.arange(len(rows))
+    # np.lexsort sorts on the last key first
+    return np.lexsort([key for missing, sort_key in reversed(sort_keys) for key in (sort_key, missing)])
+
+def get_listing_page(listing, page_current = 0, page_size = LISTING_PAGE_SIZE, sort_by = None, filter_query = ''):
+    '''Rows of one page of a listing, filtered and sorted, and the number of pages'''
+    try:
+        rows = np.flatnonzero(get_filter_mask(listing, filter_query))
+        if sort_by:
+            rows = rows[get_sort_order(listing, sort_by, rows)]
+        page_count = max(1, math.ceil(len(rows) / page_size))
+        page_rows = rows[page_current * page_size: (page_current + 1) * page_size]
+        return [listing['records'][row] for row in page_rows], page_count
+    except Exception as e:
+        traceback.print_exc()
+        return [], 1
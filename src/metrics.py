@@ -0,0 +1,190 @@
+# Libraries
+import traceback
+import time
+import functools
+from contextlib import contextmanager
+# File Management
+import os # Operating system library
+import pathlib # file paths
+import json
+import tempfile
+import threading
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# WORKER METRICS
+# ----------------------------------------------------------------------------
+# Each worker process keeps its own counters, gauges and histograms in memory and writes them to
+# METRICS_PATH/metrics_<pid>.json after every request. The /metrics route adds up the files of all
+# running workers, so it gives the same answer whichever worker serves it.
+# Metrics are keyed by (name, labels) with labels a tuple of (label, value) pairs. Request threads and the
+# background refresh thread (app) record metrics at the same time, so they are read and written under a lock.
+
+STAGE_SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+metrics_help = {
+    'a2cps_stage_seconds': ('histogram', 'Time spent in each stage of the report pipeline'),
+    'a2cps_request_seconds': ('histogram', 'Time to answer page layout and callback requests'),
+    'a2cps_response_bytes': ('gauge', 'Size of the last response to page layout and callback requests'),
+    'a2cps_store_bytes': ('gauge', 'Size of the data in each dcc.Store of the last page layout'),
+    'a2cps_frame_bytes': ('gauge', 'Size of each cleaned frame of the last snapshot cleaned, with compact dtypes as it is cached'),
+    'a2cps_report_age_seconds': ('gauge', 'Seconds since the current report was built, and since the datastore was last checked for it'),
+    'a2cps_snapshot_age_seconds': ('gauge', 'Seconds since each subjects snapshot file was last written'),
+    'a2cps_report_cache_total': ('counter', 'Report cache lookups, by result: hit, miss, rebuild and memory_hit'),
+    'a2cps_fetch_total': ('counter', 'Subjects file fetches from the datastore, by result'),
+    'a2cps_fetch_errors_total': ('counter', 'Subjects file fetches that fell back to the local snapshot or failed'),
+}
+
+worker_metrics = {'pid': os.getpid(), 'counters': {}, 'gauges': {}, 'histograms': {}}
+worker_metrics_lock = threading.RLock()
+
+def get_worker_metrics():
+    '''Metrics of this process. Metrics recorded before a fork (gunicorn --preload) belong to the parent.'''
+    with worker_metrics_lock:
+        if worker_metrics['pid'] != os.getpid():
+            worker_metrics.update({'pid': os.getpid(), 'counters': {}, 'gauges': {}, 'histograms': {}})
+        return worker_metrics
+
+def get_metric_key(name, labels):
+    return (name, tuple(sorted((str(label), str(value)) for label, value in labels.items())))
+
+def inc_counter(name, labels = {}, value = 1):
+    key = get_metric_key(name, labels)
+    with worker_metrics_lock:
+        counters = get_worker_metrics()['counters']
+        counters[key] = counters.get(key, 0) + value
+
+def set_gauge(name, labels, value):
+    key = get_metric_key(name, labels)
+    with worker_metrics_lock:
+        get_worker_metrics()['gauges'][key] = (value, time.time())
+
+def observe_histogram(name, labels, value, buckets = STAGE_SECONDS_BUCKETS):
+    key = get_metric_key(name, labels)
+    with worker_metrics_lock:
+        histograms = get_worker_metrics()['histograms']
+        if key not in histograms:
+            histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        histogram = histograms[key]
+        for i, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextmanager
+def stage_timer(stage):
+    '''Record the time spent in a block as a pipeline stage'''
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_histogram('a2cps_stage_seconds', {'stage': stage}, time.perf_counter() - start_time)
+
+def timed_stage(function):
+    '''Record the time spent in a function as a pipeline stage named after the function'''
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        with stage_timer(function.__name__):
+            return function(*args, **kwargs)
+    return timed_function
+
+# ----------------------------------------------------------------------------
+# SHARING METRICS BETWEEN WORKERS
+# ----------------------------------------------------------------------------
+
+def get_metrics_file(pid, metrics_path = METRICS_PATH):
+    return pathlib.Path(metrics_path).joinpath('metrics_{}.json'.format(pid))
+
+def flush_metrics(metrics_path = METRICS_PATH):
+    '''Write this worker's metrics to its file in metrics_path'''
+    try:
+        with worker_metrics_lock:
+            metrics = get_worker_metrics()
+            metrics_json = {kind: [[name, list(labels), value] for (name, labels), value in metrics[kind].items()]
+                            for kind in ['counters', 'gauges']}
+            # Histograms are copied, as they go on being updated once the lock is released
+            metrics_json['histograms'] = [[name, list(labels), dict(histogram, buckets=list(histogram['buckets']))]
+                                          for (name, labels), histogram in metrics['histograms'].items()]
+            pid = metrics['pid']
+        os.makedirs(metrics_path, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=metrics_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metrics_json, f)
+        os.replace(tmp_file, get_metrics_file(pid, metrics_path))
+    except Exception as e:
+        traceback.print_exc()
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def load_all_metrics(metrics_path = METRICS_PATH):
+    '''Add up the metrics files of all running workers: counters and histograms are summed, and the most
+    recently set value of each gauge is used. Files of workers that have exited are removed.'''
+    counters, gauges, histograms = {}, {}, {}
+    for metrics_file in pathlib.Path(metrics_path).glob('metrics_*.json'):
+        try:
+            pid = int(metrics_file.stem.split('_')[1])
+            if not is_running(pid):
+                os.remove(metrics_file)
+                continue
+            with open(metrics_file, 'r') as f:
+                metrics_json = json.load(f)
+        except (ValueError, OSError):
+            continue
+
+        for name, labels, value in metrics_json['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, (value, set_time) in metrics_json['gauges']:
+            key = (name, tuple(tuple(label) for label in labels))
+            if key not in gauges or set_time > gauges[key][1]:
+                gauges[key] = (value, set_time)
+        for name, labels, histogram in metrics_json['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            if key not in histograms:
+                histograms[key] = {'buckets': [0] * len(histogram['buckets']), 'sum': 0.0, 'count': 0}
+            histograms[key]['buckets'] = [a + b for a, b in zip(histograms[key]['buckets'], histogram['buckets'])]
+            histograms[key]['sum'] += histogram['sum']
+            histograms[key]['count'] += histogram['count']
+
+    return counters, gauges, histograms
+
+# ----------------------------------------------------------------------------
+# PROMETHEUS TEXT FORMAT
+# ----------------------------------------------------------------------------
+
+def format_labels(labels, extra_labels = ()):
+    labels = list(labels) + list(extra_labels)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels) + '}'
+
+def get_metrics_text(metrics_path = METRICS_PATH, buckets = STAGE_SECONDS_BUCKETS):
+    '''All workers' metrics in the Prometheus text exposition format'''
+    counters, gauges, histograms = load_all_metrics(metrics_path)
+    lines = []
+    for metric_name, (metric_type, metric_help) in metrics_help.items():
+        lines += ['# HELP {} {}'.format(metric_name, metric_help), '# TYPE {} {}'.format(metric_name, metric_type)]
+        for (name, labels), value in sorted(counters.items()):
+            if name == metric_name:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), (value, set_time) in sorted(gauges.items()):
+            if name == metric_name:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name == metric_name:
+                for bucket, bucket_count in zip(buckets, histogram['buckets']):
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bucket)]), bucket_count))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', '+Inf')]), histogram['count']))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram['sum']))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,402 @@
+# Libraries
+import traceback
+# File Management
+import os # Operating system library
+import pathlib # file paths
+import json
+import pickle
+import hashlib
+import tempfile
+import fcntl
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# import local modules
+from config_settings import *
+from metrics import *
+
+# ----------------------------------------------------------------------------
+# CACHE COUNTERS
+# ----------------------------------------------------------------------------
+# Cache lookups are counted in the a2cps_report_cache_total counter (metrics), by result:
+#   hit: report served from the cache
+#   miss: report not in the cache when requested
+#   rebuild: report built by this worker and written to the cache
+#   memory_hit: report section served from this worker's memory
+# Each worker writes its counts to its metrics file, so they can be added up across workers.
+
+cache_results = ['hit', 'miss', 'rebuild', 'memory_hit']
+
+def count_cache_lookup(result):
+    inc_counter('a2cps_report_cache_total', {'result': result})
+
+def get_report_cache_stats(metrics_path = METRICS_PATH):
+    '''Cache counters added up over all running workers'''
+    flush_metrics(metrics_path)
+    counters, gauges, histograms = load_all_metrics(metrics_path)
+    stats = dict.fromkeys(cache_results, 0)
+    for (name, labels), value in counters.items():
+        if name == 'a2cps_report_cache_total':
+            stats[dict(labels)['result']] += value
+    return stats
+
+# ----------------------------------------------------------------------------
+# CACHE KEYS
+# ----------------------------------------------------------------------------
+
+def get_snapshot_hash(subjects_files, asset_files = [], chunk_size = 1 << 20, on_chunk = None):
+    '''Content hash of the raw subjects snapshot (dictionary of mcc: subjects json file), plus any
+    asset files (e.g. display terms) that change how the snapshot is processed. on_chunk(name, chunk), if
+    given, is passed each chunk of the files as it is hashed.'''
+    snapshot_hash = hashlib.sha256()
+    named_files = [(str(mcc), subjects_files[mcc]) for mcc in sorted(subjects_files.keys(), key=str)]
+    named_files += [(os.path.basename(str(asset_file)), asset_file) for asset_file in asset_files]
+    for name, file_path in named_files:
+        snapshot_hash.update(name.encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                snapshot_hash.update(chunk)
+                if on_chunk is not None:
+                    on_chunk(name, chunk)
+    return snapshot_hash.hexdigest()
+
+def get_report_cache_key(snapshot_hash, report_date, data_source = ''):
+    '''The report tables depend on both the data snapshot and the date the report is run for'''
+    return '_'.join([data_source, report_date.strftime('%Y%m%d'), snapshot_hash[:16]]).strip('_')
+
+# ----------------------------------------------------------------------------
+# DISK STORE
+# ----------------------------------------------------------------------------
+
+def get_cache_file(cache_key, cache_path = REPORT_CACHE_PATH, suffix = '.pkl', prefix = 'report_'):
+    return pathlib.Path(cache_path).joinpath(prefix + cache_key + suffix)
+
+def load_cached_report(cache_key, cache_path = REPORT_CACHE_PATH):
+    '''Load a report from the disk cache. Returns None if the report is not cached.'''
+    cache_file = get_cache_file(cache_key, cache_path)
+    if not cache_file.exists():
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def save_cached_report(cache_key, report_dict, cache_path = REPORT_CACHE_PATH, max_entries = REPORT_CACHE_MAX_ENTRIES):
+    '''Write the report to the disk cache. The file is written to a temporary file and then
+    moved into place so other workers never read a partial report.'''
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        cache_file = get_cache_file(cache_key, cache_path)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(report_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        prune_report_cache(cache_path, max_entries)
+        return cache_file
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def prune_report_cache(cache_path = REPORT_CACHE_PATH, max_entries = REPORT_CACHE_MAX_ENTRIES, prefix = 'report_'):
+    '''Remove the oldest cached reports (or frames) beyond max_entries, along with the json manifest saved
+    next to each, and any manifest left without its pickle. The current report is never removed, however
+    old: workers serve it until the refresh replaces it.'''
+    current_report = load_current_report(cache_path)
+    current_file = get_cache_file(current_report['report_id'], cache_path) if current_report is not None else None
+    cached_files = sorted(pathlib.Path(cache_path).glob(prefix + '*.pkl'), key=os.path.getmtime, reverse=True)
+    cached_files = [cached_file for cached_file in cached_files if cached_file != current_file]
+    old_files = [old_file for cached_file in cached_files[max_entries:] for old_file in (cached_file, cached_file.with_suffix('.json'))]
+    # A manifest is written after its pickle, so one without a pickle is left over (frames_latest.json is not a manifest)
+    old_files += [manifest_file for manifest_file in pathlib.Path(cache_path).glob(prefix + '*.json')
+                  if not manifest_file.with_suffix('.pkl').exists() and manifest_file != get_cache_file('latest', cache_path, '.json', 'frames_')]
+    for old_file in old_files:
+        try:
+            os.remove(old_file)
+        except FileNotFoundError:
+            pass
+
+@contextmanager
+def cache_lock(cache_key, cache_path = REPORT_CACHE_PATH):
+    '''Hold an exclusive lock file for cache_key, shared by all workers'''
+    os.makedirs(cache_path, exist_ok=True)
+    with open(get_cache_file(cache_key, cache_path, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+@contextmanager
+def try_cache_lock(cache_key, cache_path = REPORT_CACHE_PATH):
+    '''Take the lock file for cache_key if no other process holds it. Yields whether it was taken.'''
+    os.makedirs(cache_path, exist_ok=True)
+    with open(get_cache_file(cache_key, cache_path, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def get_or_build_report(cache_key, build_report, cache_path = REPORT_CACHE_PATH):
+    '''Return the cached report for cache_key, building it with build_report() on a miss.
+    A lock file per key makes sure only one worker builds a given report; workers that
+    miss while the report is being built wait for it and then read it from the cache.'''
+    report_dict = load_cached_report(cache_key, cache_path)
+    if report_dict is not None:
+        count_cache_lookup('hit')
+        return report_dict
+
+    count_cache_lookup('miss')
+    with cache_lock(cache_key, cache_path):
+        # Another worker may have built the report while this one waited for the lock
+        report_dict = load_cached_report(cache_key, cache_path)
+        if report_dict is None:
+            report_dict = build_report()
+            count_cache_lookup('rebuild')
+            if report_dict is not None:
+                save_cached_report(cache_key, report_dict, cache_path)
+
+    return report_dict
+
+# Report parts are kept in memory by each worker as well, most recently used last, so callbacks that
+# display a section do not have to read the whole report back from disk. The background refresh builds
+# reports in a thread of the worker, hence the lock.
+report_parts_memory = OrderedDict()
+report_parts_memory_lock = threading.Lock()
+
+def remember_report_part(cache_key, part, report_part, max_entries = REPORT_MEMORY_MAX_ENTRIES):
+    with report_parts_memory_lock:
+        report_parts_memory[(cache_key, part)] = report_part
+        report_parts_memory.move_to_end((cache_key, part))
+        while len(report_parts_memory) > max_entries:
+            report_parts_memory.popitem(last=False)
+
+def recall_report_part(cache_key, part):
+    '''A report part from this worker's memory, or None'''
+    with report_parts_memory_lock:
+        if (cache_key, part) not in report_parts_memory:
+            return None
+        report_parts_memory.move_to_end((cache_key, part))
+        return report_parts_memory[(cache_key, part)]
+
+def get_or_build_report_part(cache_key, part, build_part, cache_path = REPORT_CACHE_PATH):
+    '''Return one part (e.g. a page section) of the cached report for cache_key, building it with
+    build_part(report_dict) and saving it into the cached report the first time it is asked for.
+    Returns None if the report itself is not in the cache.'''
+    report_part = recall_report_part(cache_key, part)
+    if report_part is not None:
+        count_cache_lookup('memory_hit')
+        return report_part
+
+    report_dict = load_cached_report(cache_key, cache_path)
+    if report_dict is None:
+        return None
+    if part in report_dict:
+        count_cache_lookup('hit')
+        remember_report_part(cache_key, part, report_dict[part])
+        return report_dict[part]
+
+    count_cache_lookup('miss')
+    with cache_lock(cache_key, cache_path):
+        report_dict = load_cached_report(cache_key, cache_path)
+        if report_dict is None:
+            return None
+        if part not in report_dict:
+            report_part = build_part(report_dict)
+            count_cache_lookup('rebuild')
+            if report_part is None:
+                return None
+            report_dict[part] = report_part
+            save_cached_report(cache_key, report_dict, cache_path)
+
+    remember_report_part(cache_key, part, report_dict[part])
+    return report_dict[part]
+
+# ----------------------------------------------------------------------------
+# CURRENT REPORT
+# ----------------------------------------------------------------------------
+# With the background refresh on, pages are served the current report, recorded in current_report.json
+# with its page meta data, the time it was built and the time the datastore was last checked for it. A
+# new report is built in full before the record is replaced (in one os.replace), so all workers switch
+# to it at once and never serve a report that is still being built.
+
+def get_current_report_file(cache_path = REPORT_CACHE_PATH):
+    return pathlib.Path(cache_path).joinpath('current_report.json')
+
+def load_current_report(cache_path = REPORT_CACHE_PATH):
+    '''The current report record, or None if there is none yet'''
+    try:
+        with open(get_current_report_file(cache_path), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def set_current_report(report_id, page_meta_dict, built = None, cache_path = REPORT_CACHE_PATH):
+    '''Record report_id as the current report, checked now and built at built (default now)'''
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        now = time.time()
+        current_report = {'report_id': report_id, 'page_meta_dict': page_meta_dict, 'built': built or now, 'checked': now}
+        fd, tmp_file = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(current_report, f)
+        os.replace(tmp_file, get_current_report_file(cache_path))
+        return current_report
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+# ----------------------------------------------------------------------------
+# SNAPSHOT COPIES
+# ----------------------------------------------------------------------------
+# The subjects files in DATA_PATH are replaced whenever a worker fetches a new snapshot, so a report parses
+# a copy of the bytes its snapshot hash was computed from, saved in the cache directory under that hash.
+
+def save_snapshot_files(subjects_files, asset_files = [], cache_path = REPORT_CACHE_PATH, max_entries = REPORT_CACHE_MAX_ENTRIES):
+    '''Hash the subjects files (as get_snapshot_hash) and save a copy of each, read in the same pass, named
+    by the hash. Returns the snapshot hash and the copies (dictionary of mcc: file), or None, None.'''
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        mcc_names = {str(mcc): mcc for mcc in subjects_files}
+        tmp_files = {}
+        for name in mcc_names:
+            fd, tmp_file = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+            tmp_files[name] = (tmp_file, os.fdopen(fd, 'wb'))
+        try:
+            snapshot_hash = get_snapshot_hash(subjects_files, asset_files,
+                                              on_chunk=lambda name, chunk: tmp_files[name][1].write(chunk) if name in tmp_files else None)
+            snapshot_files = {}
+            for name, mcc in mcc_names.items():
+                tmp_file, f = tmp_files.pop(name)
+                f.close()
+                snapshot_files[mcc] = get_cache_file(snapshot_hash[:16] + '_' + name, cache_path, '.json', 'snapshot_')
+                if snapshot_files[mcc].exists():
+                    os.remove(tmp_file)
+                    os.utime(snapshot_files[mcc])
+                else:
+                    os.replace(tmp_file, snapshot_files[mcc])
+        finally:
+            for tmp_file, f in tmp_files.values():
+                f.close()
+                os.remove(tmp_file)
+        prune_snapshot_files(cache_path, max_entries)
+        return snapshot_hash, snapshot_files
+    except Exception as e:
+        traceback.print_exc()
+        return None, None
+
+def prune_snapshot_files(cache_path = REPORT_CACHE_PATH, max_entries = REPORT_CACHE_MAX_ENTRIES):
+    '''Remove the copies of all but the max_entries most recently saved snapshots'''
+    snapshot_files = sorted(pathlib.Path(cache_path).glob('snapshot_*.json'), key=os.path.getmtime, reverse=True)
+    keep_keys = []
+    for snapshot_file in snapshot_files:
+        snapshot_key = snapshot_file.name.split('_')[1]
+        if snapshot_key not in keep_keys and len(keep_keys) < max_entries:
+            keep_keys.append(snapshot_key)
+    for snapshot_file in snapshot_files:
+        if snapshot_file.name.split('_')[1] not in keep_keys:
+            try:
+                os.remove(snapshot_file)
+            except FileNotFoundError:
+                pass
+
+# ----------------------------------------------------------------------------
+# CLEANED DATA SNAPSHOTS
+# ----------------------------------------------------------------------------
+# The cleaned subjects, consented and adverse_events frames are saved per snapshot hash so a
+# new report date (or an empty report cache) does not have to parse and clean the json again.
+# Frames are stored as pandas pickles, which keep the column blocks and dtypes as they are in
+# memory, next to a json manifest of the expected dtypes that is checked on reload.
+
+# Changed whenever the cleaned frames are saved with different dtypes, so frames saved by an earlier version
+# of the app are cleaned again rather than handed to table functions that no longer expect them
+frames_version = 'v2'
+
+def get_frames_cache_key(snapshot_hash):
+    return frames_version + '_' + snapshot_hash[:16]
+
+def get_frames_manifest(frames_dict):
+    '''dtypes of each dataframe in a (possibly nested) dictionary of dataframes'''
+    manifest = {}
+    for name, df in frames_dict.items():
+        if isinstance(df, dict):
+            manifest[name] = get_frames_manifest(df)
+        else:
+            manifest[name] = {str(col): str(dtype) for col, dtype in df.dtypes.items()}
+    return manifest
+
+def save_clean_frames(snapshot_hash, frames_dict, cache_path = REPORT_CACHE_PATH, max_entries = REPORT_CACHE_MAX_ENTRIES):
+    '''Write a dictionary of cleaned dataframes for a snapshot to the cache directory'''
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        cache_key = get_frames_cache_key(snapshot_hash)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(frames_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, get_cache_file(cache_key, cache_path, '.pkl', 'frames_'))
+        fd, tmp_file = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(get_frames_manifest(frames_dict), f)
+        os.replace(tmp_file, get_cache_file(cache_key, cache_path, '.json', 'frames_'))
+        prune_report_cache(cache_path, max_entries, 'frames_')
+    except Exception as e:
+        traceback.print_exc()
+
+def load_clean_frames(snapshot_hash, cache_path = REPORT_CACHE_PATH):
+    '''Load the cleaned dataframes for a snapshot. Returns None if they are not cached or if their
+    dtypes do not match the saved manifest.'''
+    cache_key = get_frames_cache_key(snapshot_hash)
+    frames_file = get_cache_file(cache_key, cache_path, '.pkl', 'frames_')
+    manifest_file = get_cache_file(cache_key, cache_path, '.json', 'frames_')
+    if not (frames_file.exists() and manifest_file.exists()):
+        return None
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        with open(frames_file, 'rb') as f:
+            frames_dict = pickle.load(f)
+        if get_frames_manifest(frames_dict) != manifest:
+            print('Cached frames for {} do not match their manifest'.format(cache_key))
+            return None
+        return frames_dict
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+# The last cleaned snapshot is recorded so the next snapshot can be updated from it record by record.
+# Frames cleaned with different display terms or screening sites (asset_hash) are not reused that way.
+
+def set_latest_clean_frames(snapshot_hash, asset_hash, cache_path = REPORT_CACHE_PATH):
+    '''Record snapshot_hash as the most recently cleaned snapshot'''
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'snapshot_hash': snapshot_hash, 'asset_hash': asset_hash}, f)
+        os.replace(tmp_file, get_cache_file('latest', cache_path, '.json', 'frames_'))
+    except Exception as e:
+        traceback.print_exc()
+
+def load_latest_clean_frames(asset_hash, cache_path = REPORT_CACHE_PATH):
+    '''Load the most recently cleaned snapshot if it was cleaned with the same assets.
+    Returns None if there is no such snapshot.'''
+    latest_file = get_cache_file('latest', cache_path, '.json', 'frames_')
+    if not latest_file.exists():
+        return None
+    try:
+        with open(latest_file, 'r') as f:
+            latest = json.load(f)
+        if latest['asset_hash'] != asset_hash:
+            return None
+        return load_clean_frames(latest['snapshot_hash'], cache_path)
+    except Exception as e:
+        traceback.print_exc()
+        return None
@@ -0,0 +1,56 @@
+# Libraries
+import traceback
+import cProfile
+import pstats
+import io
+import re
+# File Management
+import os # Operating system library
+import pathlib # file paths
+from datetime import datetime
+
+# import local modules
+from config_settings import *
+
+# ----------------------------------------------------------------------------
+# REQUEST PROFILING
+# ----------------------------------------------------------------------------
+# A request is profiled when PROFILE_REQUESTS is set, or when it carries an X-Profile header equal to
+# PROFILE_TOKEN. The cProfile stats are written to PROFILE_PATH as <time>_<pid>_<endpoint>.prof (for
+# pstats, snakeviz or flameprof) next to a .txt summary of the top PROFILE_TOP_N functions by
+# cumulative time.
+
+def is_profiling_requested(headers):
+    '''Should the request with these headers be profiled'''
+    if PROFILE_REQUESTS:
+        return True
+    return bool(PROFILE_TOKEN) and headers.get('X-Profile') == PROFILE_TOKEN
+
+def start_profile():
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def get_profile_summary(profile, top_n = PROFILE_TOP_N):
+    '''Top functions of a profile by cumulative time, as text'''
+    summary = io.StringIO()
+    stats = pstats.Stats(profile, stream=summary)
+    stats.sort_stats('cumulative').print_stats(top_n)
+    return summary.getvalue()
+
+def save_profile(profile, endpoint, profile_path = PROFILE_PATH, top_n = PROFILE_TOP_N):
+    '''Stop a profile and write it and its summary to profile_path. Returns the profile file name.'''
+    profile.disable()
+    try:
+        os.makedirs(profile_path, exist_ok=True)
+        profile_name = '_'.join([datetime.now().strftime('%Y%m%d_%H%M%S_%f'), str(os.getpid()), re.sub(r'[^A-Za-z0-9]+', '-', endpoint).strip('-')])
+        profile_file = pathlib.Path(profile_path).joinpath(profile_name + '.prof')
+        profile.dump_stats(profile_file)
+        summary = get_profile_summary(profile, top_n)
+        with open(profile_file.with_suffix('.txt'), 'w') as f:
+            f.write(summary)
+        print('Profile of {} written to {}'.format(endpoint, profile_file))
+        return profile_file.name
+    except Exception as e:
+        traceback.print_exc()
+        return None
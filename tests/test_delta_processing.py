@@ -0,0 +1,147 @@
+'''Patching the changed records of a new snapshot into the last cleaned snapshot (delta_processing) has to
+give the same frames and table counts as cleaning the new snapshot in full. The new snapshots are the
+bundled ones in src/data with a few records edited, added or removed.
+
+Run from the repository root:
+    python -m pytest tests
+'''
+import os
+import sys
+import json
+import copy
+import warnings
+
+import pandas as pd
+import pytest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+warnings.filterwarnings('ignore')
+
+from delta_processing import *
+
+# ----------------------------------------------------------------------------
+# SNAPSHOTS
+# ----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def snapshot_json():
+    snapshot = {}
+    for mcc in [1, 2]:
+        with open(os.path.join(SRC_PATH, 'data', 'subjects-{}-latest.json'.format(mcc)), 'r') as f:
+            snapshot[mcc] = json.load(f)
+    return snapshot
+
+@pytest.fixture(scope='module')
+def assets():
+    display_terms, display_terms_dict, display_terms_dict_multi = get_display_terms()
+    return get_screening_sites(), display_terms_dict, display_terms_dict_multi
+
+def write_snapshot(snapshot, path):
+    subjects_files = {}
+    for mcc, records in snapshot.items():
+        subjects_files[mcc] = os.path.join(path, 'subjects-{}-latest.json'.format(mcc))
+        with open(subjects_files[mcc], 'w') as f:
+            json.dump(records, f)
+    return subjects_files
+
+def clean_in_full(subjects_files, assets):
+    '''Frames and table counts of a snapshot cleaned in full, as get_clean_frames saves them'''
+    subjects_raw, adverse_effects, record_hashes = load_subjects_files(subjects_files)
+    subjects, consented, adverse_events = clean_subjects(subjects_raw, adverse_effects, *assets)
+    frames_dict = compact_frames({'subjects': subjects, 'consented': consented, 'adverse_events': adverse_events, 'record_hashes': record_hashes})
+    frames_dict['table_counts'] = get_table_counts(frames_dict['subjects'], frames_dict['consented'], frames_dict['adverse_events'])
+    return frames_dict
+
+def clean_by_patching(saved_frames, subjects_files, assets):
+    subjects_raw, adverse_effects, record_hashes = load_subjects_files(subjects_files)
+    frames_dict = patch_clean_frames(saved_frames, subjects_raw, adverse_effects, record_hashes, *assets)
+    return compact_frames(frames_dict) if frames_dict is not None else None
+
+@pytest.fixture(scope='module')
+def saved_frames(snapshot_json, assets, tmp_path_factory):
+    return clean_in_full(write_snapshot(snapshot_json, tmp_path_factory.mktemp('saved')), assets)
+
+def assert_counts_equal(counts, expected):
+    if isinstance(expected, dict):
+        assert set(counts) == set(expected)
+        for name in expected:
+            assert_counts_equal(counts[name], expected[name])
+    else:
+        pd.testing.assert_frame_equal(counts, expected, check_dtype=False)
+
+# ----------------------------------------------------------------------------
+# RECORD CHANGES
+# ----------------------------------------------------------------------------
+# Each change edits a copy of the snapshot in place
+
+def find_records(records, **fields):
+    return [record_id for record_id, record in records.items() if all(record.get(k) == v for k, v in fields.items())]
+
+def edit_consented_comment(snapshot):
+    for record_id in find_records(snapshot[1], start_v1_preop=1)[:3]:
+        snapshot[1][record_id]['ptinterest_comment'] = 'Edited comment'
+
+def edit_screened_only(snapshot):
+    # Records without demographics: dem_race is all N/A among the changed records
+    for record_id in find_records(snapshot[1], start_v1_preop=0, dem_race='N/A')[:2]:
+        snapshot[1][record_id]['date_of_contact'] = '2021-06-01'
+
+def consent_screened_record(snapshot):
+    record_id = find_records(snapshot[2], start_v1_preop=0)[0]
+    snapshot[2][record_id].update({'obtain_date': '2021-07-01', 'consent_process_form_complete': '2', 'main_record_id': record_id})
+
+def add_record(snapshot):
+    record_id = find_records(snapshot[1], start_v1_preop=1)[0]
+    snapshot[1][str(max(int(key) for key in snapshot[1]) + 1)] = copy.deepcopy(snapshot[1][record_id])
+
+def remove_record(snapshot):
+    del snapshot[2][find_records(snapshot[2], start_v1_preop=0)[-1]]
+
+def add_adverse_event(snapshot):
+    record_id = [record_id for record_id, record in snapshot[1].items() if record.get('adverse_effects')][0]
+    adverse_effects = snapshot[1][record_id]['adverse_effects']
+    new_instance = dict(adverse_effects[sorted(adverse_effects, key=int)[-1]], erep_local_dtime='2021-09-01 10:00:00')
+    adverse_effects[str(max(int(instance) for instance in adverse_effects) + 1)] = new_instance
+
+def remove_adverse_events(snapshot):
+    record_id = [record_id for record_id, record in snapshot[2].items() if record.get('adverse_effects')][0]
+    snapshot[2][record_id]['adverse_effects'] = {}
+
+def terminate_early(snapshot):
+    record_id = find_records(snapshot[1], start_v1_preop=1, ewdateterm='N/A')[0]
+    snapshot[1][record_id].update({'ewdateterm': '2021-08-15', 'ewprimaryreason': '1'})
+
+record_changes = [edit_consented_comment, edit_screened_only, consent_screened_record, add_record, remove_record,
+                  add_adverse_event, remove_adverse_events, terminate_early]
+
+@pytest.mark.parametrize('record_change', record_changes, ids=[change.__name__ for change in record_changes])
+def test_patch_equals_full_clean(record_change, snapshot_json, assets, saved_frames, tmp_path):
+    snapshot = copy.deepcopy(snapshot_json)
+    record_change(snapshot)
+    subjects_files = write_snapshot(snapshot, tmp_path)
+
+    patched = clean_by_patching(saved_frames, subjects_files, assets)
+    assert patched is not None, 'the changed records were not patched'
+    expected = clean_in_full(subjects_files, assets)
+    for frame_name in ['subjects', 'consented', 'adverse_events']:
+        pd.testing.assert_frame_equal(patched[frame_name].reset_index(drop=True), expected[frame_name].reset_index(drop=True))
+    assert_counts_equal(patched['table_counts'], expected['table_counts'])
+
+# ----------------------------------------------------------------------------
+# DTYPES
+# ----------------------------------------------------------------------------
+
+def test_match_dtypes_reorders_and_adds_columns():
+    # The adverse events merge can put treatment_site first, and records with no race make no dem_race_original
+    saved_df = pd.DataFrame({'record_id': [1, 2], 'treatment_site': ['a', 'b'], 'dem_race': [5.0, 8.0], 'dem_race_original': ['5', '2|5'],
+                             'start_6mo': pd.array([1, None], dtype='Int8')})
+    delta_df = pd.DataFrame({'treatment_site': ['c'], 'record_id': [3], 'dem_race': [float('nan')]})
+    matched = match_dtypes(delta_df, saved_df)
+    assert list(matched.columns) == list(saved_df.columns)
+    assert (matched.dtypes == saved_df.dtypes).all()
+    assert matched[['dem_race', 'dem_race_original', 'start_6mo']].isna().all(axis=None)
+
+def test_match_dtypes_rejects_extra_columns():
+    saved_df = pd.DataFrame({'record_id': [1, 2]})
+    assert match_dtypes(pd.DataFrame({'record_id': [3], 'new_field': ['x']}), saved_df) is None
@@ -0,0 +1,68 @@
+'''Filtering a listing table on the server (listing_tables) has to read the datatable's filter queries the way
+the datatable writes them, including values that hold operator words or are numbers.
+
+Run from the repository root:
+    python -m pytest tests
+'''
+import os
+import sys
+import warnings
+
+import pytest
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_PATH)
+warnings.filterwarnings('ignore')
+
+from listing_tables import *
+
+# ----------------------------------------------------------------------------
+# LISTING
+# ----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def listing():
+    columns = ['PID', 'Reason', 'Date']
+    data = [{'PID': 1234, 'Reason': 'Schedule change', 'Date': '08/01/2022'},
+            {'PID': 21234, 'Reason': 'Visit done early', 'Date': '08/09/2022'},
+            {'PID': 3000, 'Reason': 'missing file', 'Date': '07/15/2022'},
+            {'PID': 4000, 'Reason': 'Pain', 'Date': None}]
+    return build_listing({'columns_list': [{'id': col, 'name': col} for col in columns], 'data': data})
+
+def get_pids(listing, filter_query):
+    records, page_count = get_listing_page(listing, filter_query=filter_query)
+    return [record['PID'] for record in records]
+
+# ----------------------------------------------------------------------------
+# FILTER QUERIES
+# ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('filter_part, expected', [
+    ('{Reason} contains "schedule change"', ('Reason', 'contains', 'schedule change')),
+    ('{Reason} contains done ', ('Reason', 'contains', 'done')),
+    ('{Reason} contains missing file', ('Reason', 'contains', 'missing file')),
+    ('{Reason} contains "say \\"ne\\""', ('Reason', 'contains', 'say "ne"')),
+    ('{PID} contains 1234', ('PID', 'contains', '1234')),
+    ('{PID} >= 1000', ('PID', 'ge', 1000.0)),
+    ('{PID} le 1000', ('PID', 'le', 1000.0)),
+    ('{Reason} ieq pain', ('Reason', 'eq', 'pain')),
+    ('{Date} datestartswith 2022', ('Date', 'datestartswith', '2022')),
+    ('{Reason} contains ', (None, None, None)),
+    ('Reason contains pain', (None, None, None)),
+    ('{Reason} between pain', (None, None, None)),
+])
+def test_split_filter_part(filter_part, expected):
+    assert split_filter_part(filter_part) == expected
+
+def test_contains_value_with_operator_words(listing):
+    assert get_pids(listing, '{Reason} contains "schedule change"') == [1234]
+    assert get_pids(listing, '{Reason} contains done ') == [21234]
+    assert get_pids(listing, '{Reason} contains missing file') == [3000]
+
+def test_contains_number(listing):
+    assert get_pids(listing, '{PID} contains 1234') == [1234, 21234]
+
+def test_comparisons(listing):
+    assert get_pids(listing, '{PID} > 3000') == [21234, 4000]
+    assert get_pids(listing, '{PID} eq 1234') == [1234]
+    assert get_pids(listing, '{Date} < 08/01/2022 && {PID} ne 1234') == [3000]